@@ -81,6 +81,9 @@ from flask.ext import shelve
 app = flask.Flask(__name__)
 app.config['SHELVE_FILENAME'] = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), '_awesome.db')
+# check_awesomeness() only reads from the db, so it can use cached copies
+# of the (potentially large) word frequency dicts.
+app.config['SHELVE_CACHE_SIZE'] = 16
 shelve.init_app(app)
 log = logging.getLogger('awesome')
 
@@ -1,14 +1,123 @@
 """Integrate the shelve module with flask."""
 import os
+import time
+import mmap
+import errno
 import shelve
 import fcntl
-import time
+import json
+import struct
+import hashlib
+import shutil
+import marshal
+import zlib
+import atexit
+import threading
+import uuid
+import bisect
+import contextlib
+import collections
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import anydbm as dbm
+    from whichdb import whichdb
+except ImportError:
+    import dbm
+    from dbm import whichdb
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 
 import flask
 from flask import _request_ctx_stack
+from flask.signals import Namespace
+from werkzeug.exceptions import ServiceUnavailable
+
 
+# The lock file doubles as a write generation counter, stored as an
+# unsigned 64 bit int at the start of the file.
+_GENERATION = struct.Struct('>Q')
+# Fields of a hash (see _ShelveSession.hash) are stored under keys
+# that start with this prefix, followed by the hash name and a NUL.
+_HASH_PREFIX = '\x00hash\x00'
+# Blobs (see _ShelveSession.put_stream) are stored under keys that start
+# with this prefix, followed by the blob name, a NUL and the number of
+# the chunk; the blob's size and number of chunks are stored under the
+# prefix, name and NUL.
+_BLOB_PREFIX = '\x00blob\x00'
+_BLOB_CHUNK_SIZE = 64 * 1024
+# The log backend's index file starts with a header: magic, sequence
+# counter, number of the current log file, published length of the log,
+# write generation, number of slots, number of slots in use and the
+# number of bytes of dead records in the log.  The slots follow it.
+_LOG_INDEX_MAGIC = b'FSHIDX01'
+_LOG_INDEX_HEADER = struct.Struct('>8sQQQQQQQ')
+_LOG_SEQUENCE = struct.Struct('>Q')
+# A slot is a key hash and the offset of the key's latest record, 0 if
+# the slot is empty.
+_LOG_SLOT = struct.Struct('>QQ')
+_LOG_MIN_SLOTS = 64
+# Every log file starts with the magic, so no record is at offset 0.
+_LOG_MAGIC = b'FSHLOG01'
+# A record is the offset of the key's previous record, the key length
+# and the value length, followed by the key and the value.
+_LOG_RECORD = struct.Struct('>QII')
+_LOG_DELETED = 0xffffffff
+# The log is compacted once more than half of it is dead records, unless
+# it's smaller than this.
+_LOG_COMPACT_MIN_BYTES = 1 << 20
+# Writers buffer up to this many bytes of records before writing them.
+_LOG_BUFFER_BYTES = 64 * 1024
+# How long readers wait for a writer to finish updating the index before
+# deciding it died part way through.
+_LOG_STALL_SECONDS = 1.0
+# Records that weren't pickled start with this, followed by the tag of
+# the serializer that wrote them (or of the compressor that compressed
+# them).  No pickle starts with a NUL.
+_SERIALIZER_TAG = b'\x00'
+# What's measured of every request, see _Metrics.
+_METRICS = (
+    'locks', 'lock_wait_seconds', 'lock_hold_seconds', 'lock_timeouts',
+    'open_seconds', 'close_seconds', 'keys_read', 'keys_written',
+    'keys_deleted', 'bytes_read', 'bytes_written',
+)
+# The counters get_stats also keeps a histogram of, and the upper bounds
+# of the histograms' buckets: 10us, doubling up to about 10s.
+_STATS_HISTOGRAMS = (
+    'lock_wait_seconds', 'lock_hold_seconds', 'open_seconds',
+    'close_seconds',
+)
+_HISTOGRAM_BOUNDS = tuple(0.00001 * 2 ** i for i in range(21))
+# The counters returned by get_stats.
+_STATS_COUNTERS = (
+    'compressed_records', 'compress_bytes_in', 'compress_bytes_saved',
+    'compress_seconds', 'decompressed_records', 'decompress_seconds',
+) + _METRICS
+# The best clock there is for timing short operations.
+_timer = getattr(time, 'perf_counter', time.time)
 
-LOCK_POLL_SECS = 0.02
+_signals = Namespace()
+#: Sent when a request that used the db is torn down, with the app as the
+#: sender and a dict of what the request did as ``metrics`` (the names
+#: are the per request counters of get_stats).
+shelve_metrics = _signals.signal('shelve-metrics')
 
 
 def init_app(app):
@@ -28,104 +137,3327 @@ def init_app(app):
                            "app configuration.")
     app.config.setdefault('SHELVE_PROTOCOL', None)
     app.config.setdefault('SHELVE_WRITEBACK', False)
+    app.config.setdefault('SHELVE_WRITEBACK_MAX_ENTRIES', 0)
+    app.config.setdefault('SHELVE_WRITEBACK_MAX_BYTES', 0)
+    app.config.setdefault('SHELVE_POOL_SIZE', 0)
+    app.config.setdefault('SHELVE_LOCK_POLICY', 'writer')
+    app.config.setdefault('SHELVE_LOCK_TIMEOUT', None)
+    app.config.setdefault('SHELVE_READ_LOCK_TIMEOUT',
+                          app.config['SHELVE_LOCK_TIMEOUT'])
+    app.config.setdefault('SHELVE_WRITE_LOCK_TIMEOUT',
+                          app.config['SHELVE_LOCK_TIMEOUT'])
+    app.config.setdefault('SHELVE_LOCK_RETRY_AFTER', 1)
+    app.config.setdefault('SHELVE_SHARDS', 1)
+    app.config.setdefault('SHELVE_CACHE_SIZE', 0)
+    app.config.setdefault('SHELVE_WRITE_BEHIND', False)
+    app.config.setdefault('SHELVE_BACKEND', 'dbm')
+    app.config.setdefault('SHELVE_SERIALIZER', 'pickle')
+    app.config.setdefault('SHELVE_COMPRESS', None)
+    app.config.setdefault('SHELVE_COMPRESS_MIN_BYTES', 1024)
+    app.config.setdefault('SHELVE_SERVER_TIMING', False)
+    app.config.setdefault('SHELVE_REPLICA', False)
+    app.config.setdefault('SHELVE_REPLICA_INTERVAL', 60)
+    app.config.setdefault('SHELVE_REPLICA_WRITES', 0)
+    app.config.setdefault('SHELVE_REPLICA_MAX_STALENESS', None)
     app.config.setdefault('SHELVE_LOCKFILE',
                           app.config['SHELVE_FILENAME'] + '.lock')
     app.extensions['shelve'] = _Shelve(app)
 
 
-def get_shelve(mode='c'):
+def get_shelve(mode='c', lazy=False, max_staleness=None):
     """Get an instance of shelve.
 
-    This function will return a ``shelve.Shelf`` instance.
-    It does this by finding the shelve object associated with
-    the current flask app (using ``flask.current_app``).
+    This function will return a dict like object backed by a
+    ``shelve.Shelf`` instance.  It does this by finding the shelve
+    object associated with the current flask app (using
+    ``flask.current_app``).
+
+    Every call within a request returns the same object, and the db is
+    only opened once per request.  If the db was opened for reading and
+    ``get_shelve`` is then called with a write mode, the existing object
+    is upgraded to a writer.  The upgrade releases the read lock before
+    taking the write lock, so anything read before the upgrade may have
+    been changed by another writer in between.
+
+    If ``lazy`` is true, the db isn't locked and opened until a key is
+    first used, rather than right away.
+
+    With ``SHELVE_REPLICA`` on, a request that opens the db with mode='r'
+    reads from the replica, without locking anything, as long as the
+    replica is at most ``max_staleness`` seconds old (defaults to
+    ``SHELVE_REPLICA_MAX_STALENESS``).  Otherwise it reads the db itself.
+    Once upgraded to a writer it reads the db itself too.
+
+    """
+    return flask.current_app.extensions['shelve'].open_db(
+        mode=mode, lazy=lazy, max_staleness=max_staleness)
+
+
+def get_stats():
+    """Return a dict of the counters of the current app's db.
+
+    The counters are shared by every thread of the process, and count
+    from when the app was initialized:
+
+    * ``compressed_records`` - Records stored compressed.
+    * ``compress_bytes_in`` - Their size before compression.
+    * ``compress_bytes_saved`` - How much smaller compression made them.
+    * ``compress_seconds`` - Time spent compressing, including values
+      that didn't get any smaller.
+    * ``decompressed_records`` - Compressed records read.
+    * ``decompress_seconds`` - Time spent decompressing them.
+
+    These are also measured for every request, see ``shelve_metrics``:
+
+    * ``locks`` - Locks acquired (or snapshots taken, by readers of
+      backends that don't lock reads).
+    * ``lock_wait_seconds`` - Time spent waiting for them.
+    * ``lock_hold_seconds`` - Time they were held for.
+    * ``lock_timeouts`` - Locks given up on, see ShelveLockTimeoutError.
+      The time spent waiting for them is included in
+      ``lock_wait_seconds``.
+    * ``open_seconds`` - Time spent opening the db (or taking a handle
+      from the pool) once locked.
+    * ``close_seconds`` - Time spent syncing and closing the db (or
+      returning the handle to the pool).
+    * ``keys_read``, ``keys_written`` and ``keys_deleted`` - Records
+      read, written and deleted.
+    * ``bytes_read`` and ``bytes_written`` - Their serialized size.
+
+    ``histograms`` maps the names of the ``_seconds`` counters other than
+    the compression ones to a histogram of the times that were added up,
+    a list of ``(upper bound, count)`` pairs with bounds from 10us
+    doubling up to about 10s.  The last bound is None, for anything
+    longer.
+
+    """
+    return flask.current_app.extensions['shelve'].stats.snapshot()
+
+
+@contextlib.contextmanager
+def shelve_session(mode='c', max_staleness=None):
+    """Use the db for the duration of a ``with`` block.
+
+    ::
+
+        with shelve_session('r') as db:
+            user = db['user']
+        return render_template('user.html', user=user)
+
+    The db is locked when a key is first used, and the lock is released
+    as soon as the block exits rather than when the request is torn
+    down, so it isn't held while the view does unrelated work such as
+    rendering a template.  Inside a request this is the same object
+    ``get_shelve`` returns, and it's closed when the block exits; calling
+    ``get_shelve`` again opens it again.  Outside of a request (but with
+    an app context) a new session is used.  ``max_staleness`` is as for
+    ``get_shelve``.
+
+    """
+    ext = flask.current_app.extensions['shelve']
+    if _request_ctx_stack.top is not None:
+        db = ext.open_db(mode=mode, lazy=True, max_staleness=max_staleness)
+    else:
+        db = _ShelveSession(ext.stores, ext.queue)
+        db.open(mode, lazy=True, max_staleness=max_staleness)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_shelve_async(mode='c', max_staleness=None):
+    """Get the db from a coroutine, without blocking the event loop.
+
+    The result can be awaited, which opens the db and returns an
+    ``AsyncShelve`` whose methods return awaitables::
+
+        db = await get_shelve_async('r')
+        user = await db.get('user')
+
+    or used as an async context manager, which also closes the db when
+    the block exits, like ``shelve_session``::
+
+        async with get_shelve_async('c') as db:
+            await db.set('user', user)
+
+    Waiting for the locks and every read and write of the db happen in
+    the event loop's default executor, so other coroutines keep running
+    while a request waits for a writer.  Inside a request this is the
+    same session ``get_shelve`` returns.  Outside of a request (but with
+    an app context) a new session is used, which has to be closed with
+    ``await db.close()`` if it isn't used as a context manager.
+    ``max_staleness`` is as for ``get_shelve``.
+
+    """
+    if asyncio is None:
+        raise RuntimeError("get_shelve_async requires asyncio.")
+    ext = flask.current_app.extensions['shelve']
+    if _request_ctx_stack.top is not None:
+        session = ext.session()
+    else:
+        session = _ShelveSession(ext.stores, ext.queue)
+    return _AsyncOpen(AsyncShelve(session), mode, max_staleness)
+
+
+class ShelveTimeoutError(RuntimeError):
+    """Raised when waiting for something took longer than allowed."""
+
+
+class ShelveLockTimeoutError(ShelveTimeoutError, ServiceUnavailable):
+    """Raised when the db couldn't be locked within the lock timeout.
+
+    See ``SHELVE_LOCK_TIMEOUT``.  This is also an HTTP 503 error (a
+    werkzeug ``ServiceUnavailable``), so a request that doesn't catch it
+    is answered with a 503 response, with a ``Retry-After`` header of
+    ``retry_after`` seconds, rather than waiting any longer.
+
+    """
+    def __init__(self, message, retry_after):
+        ServiceUnavailable.__init__(self, message)
+        self.args = (message,)
+        self.retry_after = retry_after
+
+    def get_headers(self, *args, **kwargs):
+        headers = ServiceUnavailable.get_headers(self, *args, **kwargs)
+        if self.retry_after is not None and \
+                'Retry-After' not in dict(headers):
+            headers.append(('Retry-After', str(self.retry_after)))
+        return headers
+
+    def __str__(self):
+        return self.args[0]
+
+
+class ShelveConflictError(RuntimeError):
+    """Raised when a shard can't be locked without risking a deadlock.
+
+    Shards are locked in ascending order.  When a request that has
+    already written to a shard needs a lower numbered shard that another
+    request holds, waiting for it could deadlock, so this is raised
+    instead.
 
     """
-    return flask.current_app.extensions['shelve'].open_db(mode=mode)
 
 
 class _Shelve(object):
     def __init__(self, app):
         self.app = app
         self.app.teardown_request(self.close_db)
-        self._lock = _FileLock(app.config['SHELVE_LOCKFILE'])
+        cfg = app.config
+        self.stats = _Stats()
+        if cfg['SHELVE_SHARDS'] == 1:
+            self.stores = [_Store(cfg['SHELVE_FILENAME'],
+                                  cfg['SHELVE_LOCKFILE'], cfg, self.stats)]
+        else:
+            self.stores = [
+                _Store('%s.%d' % (cfg['SHELVE_FILENAME'], i),
+                       '%s.%d' % (cfg['SHELVE_LOCKFILE'], i), cfg,
+                       self.stats)
+                for i in range(cfg['SHELVE_SHARDS'])]
+        if cfg['SHELVE_WRITE_BEHIND']:
+            self.queue = _WriteQueue(self.stores)
+        else:
+            self.queue = None
+        if cfg['SHELVE_SERVER_TIMING']:
+            self.app.after_request(self.add_server_timing)
+
+    def session(self):
+        """Return the current request's session, without opening it."""
+        top = _request_ctx_stack.top
+        session = getattr(top, 'shelve_session', None)
+        if session is None:
+            session = top.shelve_session = _ShelveSession(self.stores,
+                                                          self.queue)
+        return session
+
+    def open_db(self, mode='r', lazy=False, max_staleness=None):
+        session = self.session()
+        session.open(mode, lazy, max_staleness)
+        return session
+
+    def close_db(self, ignore_arg):
+        session = getattr(_request_ctx_stack.top, 'shelve_session', None)
+        if session is not None:
+            session.close()
+            shelve_metrics.send(self.app, metrics=session.metrics.as_dict())
+
+    def add_server_timing(self, response):
+        session = getattr(_request_ctx_stack.top, 'shelve_session', None)
+        if session is None:
+            return response
+        metrics = session.metrics
+        # Locks still held are released at teardown, after the response
+        # has been made; count them as held until now.
+        now = _timer()
+        hold = metrics.lock_hold_seconds + sum(
+            now - handle.locked_at
+            for fileno, handle in session._held.values())
+        response.headers.add('Server-Timing', ', '.join(
+            'shelve-%s;dur=%.3f' % (name, seconds * 1000)
+            for name, seconds in (('lock-wait', metrics.lock_wait_seconds),
+                                  ('lock-hold', hold),
+                                  ('open', metrics.open_seconds),
+                                  ('close', metrics.close_seconds))))
+        return response
+
+
+def _is_write_mode(mode):
+    return mode in ('c', 'w', 'n')
+
+
+def _backend_class(backend):
+    # SHELVE_BACKEND is either the name of a backend, or a backend class.
+    if callable(backend):
+        return backend
+    try:
+        return _BACKENDS[backend]
+    except KeyError:
+        raise ValueError("Unknown backend %r, expected one of: %s" %
+                         (backend, ', '.join(sorted(_BACKENDS))))
+
+
+class _Store(object):
+    """A single db file, its lock, its pool of open handles and its cache.
+    """
+    def __init__(self, filename, lockfile, config, stats):
+        self.filename = filename
+        self._config = config
+        self._stats = stats
+        self._lock = _FileLock(lockfile, config['SHELVE_LOCK_POLICY'])
+        self.backend = _backend_class(config['SHELVE_BACKEND'])(filename)
+        self.codec = _Codec(_serializer(config['SHELVE_SERIALIZER'],
+                                        config['SHELVE_PROTOCOL']),
+                            _compressor(config['SHELVE_COMPRESS']),
+                            config['SHELVE_COMPRESS_MIN_BYTES'], stats)
         # "touch" the db file so that view functions can
         # open the db with mode='r' and not have to worry
         # about the db not existing.
         self._open_db('c').close()
+        if config['SHELVE_POOL_SIZE']:
+            self._pool = _HandlePool(config['SHELVE_POOL_SIZE'],
+                                     self._open_db)
+        else:
+            self._pool = None
+        if config['SHELVE_CACHE_SIZE']:
+            self.cache = _ValueCache(config['SHELVE_CACHE_SIZE'])
+        else:
+            self.cache = None
+        if config['SHELVE_REPLICA']:
+            self.replica = _Replica(self, lockfile + '.replica', config,
+                                    stats)
+        else:
+            self.replica = None
 
-    def open_db(self, mode='r'):
-        if self._is_write_mode(mode):
-            fileno = self._lock.acquire_write_lock()
-            writer = self._open_db(mode)
-            writer.fileno = fileno
-            _request_ctx_stack.top.shelve_writer = writer
-            return writer
+    def acquire(self, mode, blocking=True, metrics=None):
+        """Lock the db and return the lock fileno and a handle.
+
+        If ``blocking`` is false and the lock isn't free, None is
+        returned.  If the lock isn't acquired within the configured
+        timeout, ShelveLockTimeoutError is raised.  Readers of a backend
+        that doesn't lock reads get a fileno of None.  The time spent
+        waiting for the lock and getting the handle is added to the app's
+        stats and to ``metrics``, the _Metrics of the session, if given.
+
+        """
+        start = _timer()
+        if not _is_write_mode(mode) and not self.backend.lock_reads:
+            handle = self._checkout_reader(mode)
+            self._locked(handle, start, start, metrics)
+            return None, handle
+        cfg = self._config
+        if _is_write_mode(mode):
+            fileno = self._lock.acquire_write_lock(
+                blocking, cfg['SHELVE_WRITE_LOCK_TIMEOUT'])
+            release = self._lock.release_write_lock
         else:
-            fileno = self._lock.acquire_read_lock()
-            reader = self._open_db(mode)
-            reader.fileno = fileno
-            _request_ctx_stack.top.shelve_reader = reader
-            return reader
+            fileno = self._lock.acquire_read_lock(
+                blocking, cfg['SHELVE_READ_LOCK_TIMEOUT'])
+            release = self._lock.release_read_lock
+        if fileno is None:
+            if blocking:
+                raise self._timed_out(mode, start, metrics)
+            return None
+        locked = _timer()
+        try:
+            generation = self._generation(fileno)
+            if self.cache is not None and not _is_write_mode(mode):
+                self.cache.validate(generation)
+            handle = self._checkout(mode, generation)
+            handle.generation = generation
+        except:
+            release(fileno)
+            raise
+        if _is_write_mode(mode):
+            self._begin_write(fileno, handle)
+        self._locked(handle, start, locked, metrics)
+        return fileno, handle
+
+    def _timed_out(self, mode, start, metrics):
+        self._record(metrics, lock_timeouts=1,
+                     lock_wait_seconds=_timer() - start)
+        return ShelveLockTimeoutError(
+            "Timed out waiting for the %s lock of %s." % (
+                'write' if _is_write_mode(mode) else 'read', self.filename),
+            self._config['SHELVE_LOCK_RETRY_AFTER'])
+
+    def _locked(self, handle, start, locked, metrics):
+        # The handle has been checked out, ``locked`` seconds after
+        # ``start`` its lock was acquired.
+        now = _timer()
+        handle.locked_at = locked
+        handle.metrics = _Metrics()
+        self._record(metrics, locks=1, lock_wait_seconds=locked - start,
+                     open_seconds=now - locked)
+
+    def _released(self, handle, start, metrics):
+        # Call before the handle is checked in, returns a function to call
+        # once it has been, which records how long the lock was held.  The
+        # handle may be checked out by someone else by then.
+        locked_at, io = handle.locked_at, handle.metrics
+
+        def released():
+            now = _timer()
+            self._record(metrics, lock_hold_seconds=now - locked_at,
+                         close_seconds=now - start,
+                         keys_read=io.keys_read,
+                         keys_written=io.keys_written,
+                         keys_deleted=io.keys_deleted,
+                         bytes_read=io.bytes_read,
+                         bytes_written=io.bytes_written)
+        return released
+
+    def _record(self, metrics, **counts):
+        self._stats.add(**counts)
+        if metrics is not None:
+            metrics.add(**counts)
+
+    def _begin_write(self, fileno, handle):
+        try:
+            self.backend.begin_write(handle.dict)
+        except:
+            self._checkin(fileno, handle, dirty=False)
+            self._lock.release_write_lock(fileno)
+            raise
 
-    def _is_write_mode(self, mode):
-        return mode in ('c', 'w', 'n')
+    def _checkout_reader(self, mode):
+        # Reads aren't locked, the handle reads from a snapshot of the
+        # db instead, which also tells us the generation it's from.
+        handle = self._checkout(mode, None)
+        try:
+            handle.generation = self.backend.begin_read(handle.dict)
+            if self.cache is not None:
+                self.cache.validate(handle.generation)
+        except:
+            self._checkin(None, handle, dirty=False)
+            raise
+        return handle
+
+    def upgrade(self, fileno, reader, mode, metrics=None):
+        """Trade a read lock and handle for a write lock and handle.
+
+        Returns the new lock fileno and handle.
+
+        """
+        released = self._released(reader, _timer(), metrics)
+        self._checkin(fileno, reader, dirty=False)
+        released()
+        if fileno is None:
+            return self.acquire(mode, metrics=metrics)
+        start = _timer()
+        if not self._lock.upgrade_lock(
+                fileno, self._config['SHELVE_WRITE_LOCK_TIMEOUT']):
+            raise self._timed_out(mode, start, metrics)
+        locked = _timer()
+        try:
+            generation = self._generation(fileno)
+            handle = self._checkout(mode, generation)
+            handle.generation = generation
+        except:
+            self._lock.release_write_lock(fileno)
+            raise
+        self._begin_write(fileno, handle)
+        self._locked(handle, start, locked, metrics)
+        return fileno, handle
+
+    def release(self, fileno, handle, write, dirty=True, metrics=None):
+        """Unlock the db and check in or close the handle.
+
+        The write generation is only bumped if ``write`` and ``dirty``
+        are both true.
+
+        """
+        released = self._released(handle, _timer(), metrics)
+        modified = write and dirty and handle.modified
+        self._checkin(fileno, handle, write and dirty)
+        if write:
+            self._lock.release_write_lock(fileno)
+        elif fileno is not None:
+            self._lock.release_read_lock(fileno)
+        released()
+        if modified and self.replica is not None:
+            self.replica.wrote()
 
     def _open_db(self, flag):
-        cfg = self.app.config
-        return shelve.open(
-            filename=cfg['SHELVE_FILENAME'],
-            flag=flag,
-            protocol=cfg['SHELVE_PROTOCOL'],
-            writeback=cfg['SHELVE_WRITEBACK']
+        cfg = self._config
+        handle = _Shelf(
+            self.backend.open(flag),
+            self.codec,
+            writeback=cfg['SHELVE_WRITEBACK'],
+            max_entries=cfg['SHELVE_WRITEBACK_MAX_ENTRIES'],
+            max_bytes=cfg['SHELVE_WRITEBACK_MAX_BYTES'],
+            writable=flag != 'r'
         )
+        # Truncating the db counts as a write.
+        handle.modified = flag == 'n'
+        return handle
 
-    def close_db(self, ignore_arg):
-        top = _request_ctx_stack.top
-        if hasattr(top, 'shelve_writer'):
-            writer = top.shelve_writer
-            writer.close()
-            self._lock.release_write_lock(writer.fileno)
-        elif hasattr(top, 'shelve_reader'):
-            reader = top.shelve_reader
-            reader.close()
-            self._lock.release_read_lock(reader.fileno)
+    def _generation(self, fileno):
+        # The generation is only needed to validate pooled handles
+        # and cached values.  Handles of backends that don't lock reads
+        # always see the latest writes, and their readers get the
+        # generation from their snapshot.
+        if self._pool is None and self.cache is None:
+            return None
+        if not self.backend.lock_reads:
+            return None
+        return self._lock.generation(fileno)
 
+    def _checkout(self, mode, generation):
+        if self._pool is None:
+            return self._open_db(mode)
+        if mode == 'n':
+            # 'n' truncates the db, so it always needs a new handle.
+            handle = self._open_db(mode)
+            handle.flag = 'c'
+            return handle
+        if _is_write_mode(mode):
+            mode = 'c'
+        return self._pool.checkout(mode, generation)
 
-class _FileLock(object):
-    def __init__(self, lockfile):
-        self._filename = lockfile
-        self._waiting_for_write_lock = False
-        self._waiting_for_read_lock = False
-        # Touch the file so we can acquire read locks.
-        open(self._filename, 'w').close()
-
-    def acquire_read_lock(self):
-        # Keep in mind that we're operating in a multithreaded environment.
-        # If someone is waiting on a write lock, we can essentially keep them
-        # waiting indefinitely if we keep on handing on read locks (there
-        # can be multiple read locks issued at any time).  So instead, if
-        # someone is waiting on a write lock, we poll until they've
-        # acquired the lock and then block on aquiring a lock.
-        while self._waiting_for_write_lock:
-            time.sleep(LOCK_POLL_SECS)
-        fileno = os.open(self._filename, os.O_RDWR)
-        self._waiting_for_read_lock = True
-        fcntl.flock(fileno, fcntl.LOCK_SH)
-        self._waiting_for_read_lock = False
-        return fileno
+    def _checkin(self, fileno, handle, dirty):
+        if dirty:
+            # Writes have to be flushed before the new generation is
+            # published.  With writeback, a writer that turns out not to
+            # have changed anything doesn't need a new generation.
+            if self._pool is None:
+                handle.close()
+                if handle.modified:
+                    self._lock.bump_generation(fileno)
+                return
+            handle.sync()
+            if handle.modified:
+                generation = self._lock.bump_generation(fileno)
+            else:
+                generation = self._generation(fileno)
+        else:
+            # Only writers write back what they've read.
+            handle.drop_cache()
+            self.backend.end_read(handle.dict)
+            if self._pool is None:
+                handle.close()
+                return
+            generation = self._generation(fileno)
+        if not self.backend.lock_reads:
+            generation = None
+        self._pool.checkin(handle, generation)
 
-    def acquire_write_lock(self):
-        fileno = os.open(self._filename, os.O_RDWR)
-        self._waiting_for_write_lock = True
-        fcntl.flock(fileno, fcntl.LOCK_EX)
-        self._waiting_for_write_lock = False
-        return fileno
 
-    def release_read_lock(self, fileno):
-        fcntl.flock(fileno, fcntl.LOCK_UN)
-        os.close(fileno)
+class _Replica(object):
+    """A read only copy of a store's db, for readers that don't mind
+    reading something a little out of date.
 
-    def release_write_lock(self, fileno):
-        fcntl.flock(fileno, fcntl.LOCK_UN)
-        os.close(fileno)
+    The copy is a store of its own, with the snapshot backend, so reading
+    it doesn't take any lock, and a refresh replaces it atomically.  It's
+    refreshed in a background thread once it's older than
+    ``SHELVE_REPLICA_INTERVAL`` seconds, or after
+    ``SHELVE_REPLICA_WRITES`` writes by this process, whichever comes
+    first.  Only one process or thread refreshes it at a time, the
+    others don't wait for it.
+
+    """
+    def __init__(self, primary, lockfile, config, stats):
+        self._primary = primary
+        self.store = _Store(primary.filename + '.replica', lockfile,
+                            dict(config, SHELVE_BACKEND='snapshot',
+                                 SHELVE_REPLICA=False), stats)
+        self._interval = config['SHELVE_REPLICA_INTERVAL']
+        self._max_writes = config['SHELVE_REPLICA_WRITES']
+        self._max_staleness = config['SHELVE_REPLICA_MAX_STALENESS']
+        self._mutex = threading.Lock()
+        # Writes since the last refresh began.
+        self._writes = 0
+        self._thread = None
+
+    def acquire(self, max_staleness=None, metrics=None):
+        """Return a lock fileno (always None) and a handle of the copy.
+
+        None is returned instead if the copy hasn't been made yet, or it
+        was made more than ``max_staleness`` seconds ago, which defaults
+        to ``SHELVE_REPLICA_MAX_STALENESS`` (None for any age).  A refresh
+        is started if the copy is due one.
+
+        """
+        if max_staleness is None:
+            max_staleness = self._max_staleness
+        fileno, handle = self.store.acquire('r', metrics=metrics)
+        # Version 0 is the empty db the store starts with.
+        if not handle.generation:
+            age = None
+        else:
+            age = time.time() - handle.dict.as_of
+        if age is None or (self._interval is not None and
+                           age >= self._interval):
+            self.refresh_in_background()
+        if age is None or (max_staleness is not None and
+                           age > max_staleness):
+            self.store.release(fileno, handle, False, metrics=metrics)
+            return None
+        return fileno, handle
+
+    def release(self, fileno, handle, metrics=None):
+        self.store.release(fileno, handle, False, metrics=metrics)
+
+    def wrote(self):
+        """Count a write to the primary, refreshing the copy if it's due.
+        """
+        if not self._max_writes:
+            return
+        with self._mutex:
+            self._writes += 1
+            due = self._writes >= self._max_writes
+        if due:
+            self.refresh_in_background()
+
+    def refresh_in_background(self):
+        with self._mutex:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self.refresh)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def refresh(self):
+        """Copy the primary db to the replica.
+
+        Returns False, without waiting, if it's already being refreshed.
+
+        """
+        acquired = self.store.acquire('n', blocking=False)
+        if acquired is None:
+            return False
+        fileno, copy = acquired
+        try:
+            with self._mutex:
+                self._writes = 0
+            as_of = time.time()
+            source_fileno, source = self._primary.acquire('r')
+            try:
+                # The serialized records are copied as they are.
+                for key in source.dict.keys():
+                    copy.dict[key] = source.dict[key]
+            finally:
+                self._primary.release(source_fileno, source, False)
+        except:
+            self.store.release(fileno, copy, True, dirty=False)
+            raise
+        copy.dict.published_at = as_of
+        self.store.release(fileno, copy, True)
+        return True
+
+
+class _ShelveSession(MutableMapping):
+    """The db as seen by a single request.
+
+    A session holds at most one lock and one handle per store, they're
+    released when the session is closed (at the latest, when the request
+    is torn down).
+
+    With a single store, the db is locked as soon as it's opened, unless
+    it's opened lazily.  With several shards, each shard is only locked
+    when a key that hashes to it is first used.  Shards are locked in
+    ascending order to avoid deadlocks: if a lower shard is needed after a
+    higher one, the held shards are released and locked again in order,
+    unless they've already been written to.  In that case the lower shard
+    is only taken if it's free, otherwise ShelveConflictError is raised.
+
+    """
+    def __init__(self, stores, queue=None, metrics=None):
+        self._stores = stores
+        self._queue = queue
+        # What the session has done so far, see shelve_metrics.
+        self.metrics = metrics if metrics is not None else _Metrics()
+        # Futures of the writes queued in write behind mode.
+        self._futures = []
+        self._write_behind = False
+        self._thread = threading.current_thread()
+        # Store index -> (lock fileno, handle).
+        self._held = {}
+        # Indexes of held stores whose handle is of their replica.
+        self._replicated = set()
+        # How old a replica this session may read, False for none.
+        self._max_staleness = False
+        # Indexes of held stores that may have been written to.
+        self._dirty = set()
+        self._mode = None
+        self.writable = False
+
+    def open(self, mode, lazy=False, max_staleness=None):
+        write = _is_write_mode(mode)
+        if write and self._queue is not None:
+            if mode == 'n':
+                raise ValueError("The db can't be opened with mode 'n' in "
+                                 "write behind mode.")
+            # Writes go to the queue, the session itself only reads.
+            self._write_behind = True
+            mode = 'r'
+            write = False
+        if self._mode is None:
+            self._mode = mode
+            self.writable = write
+            if not write and not self._write_behind:
+                self._max_staleness = max_staleness
+        elif write and not self.writable:
+            self._upgrade(mode)
+        if len(self._stores) == 1 and not lazy:
+            self._handle(0)
+
+    def _upgrade(self, mode):
+        self._max_staleness = False
+        if len(self._stores) == 1 and self._held and not self._replicated:
+            # If the upgrade fails the session is left closed.
+            fileno, reader = self._held.pop(0)
+            self._held[0] = self._stores[0].upgrade(fileno, reader, mode,
+                                                    self.metrics)
+        else:
+            # Upgrading shards in place could deadlock, as the lower ones
+            # would be locked while the higher ones are held.
+            self._release_all()
+        self._mode = mode
+        self.writable = True
+
+    def close(self):
+        self._release_all()
+        self._mode = None
+        self.writable = False
+        self._write_behind = False
+        self._max_staleness = False
+        self._futures = []
+
+    def _release_all(self):
+        held, self._held = self._held, {}
+        dirty, self._dirty = self._dirty, set()
+        replicated, self._replicated = self._replicated, set()
+        for index in sorted(held, reverse=True):
+            fileno, handle = held[index]
+            if index in replicated:
+                self._stores[index].replica.release(fileno, handle,
+                                                    self.metrics)
+            else:
+                self._stores[index].release(fileno, handle, self.writable,
+                                            index in dirty, self.metrics)
+
+    def _index(self, key):
+        if len(self._stores) == 1:
+            return 0
+        if key.startswith(_BLOB_PREFIX):
+            # A blob's chunks are all in the same shard.
+            key = key[:key.rindex('\x00')]
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return (zlib.crc32(key) & 0xffffffff) % len(self._stores)
+
+    def _handle(self, index, write=False):
+        if self._mode is None:
+            raise ValueError("The shelve session is closed.")
+        if index in self._held:
+            handle = self._held[index][1]
+        else:
+            handle = self._lock_store(index)
+        if write or (self.writable and handle.writeback):
+            # With writeback, anything read may be written back later.
+            self._dirty.add(index)
+        return handle
+
+    def _lock_store(self, index):
+        store = self._stores[index]
+        if self._max_staleness is not False and store.replica is not None:
+            acquired = store.replica.acquire(self._max_staleness,
+                                             self.metrics)
+            if acquired is not None:
+                # Reading the replica doesn't lock anything, so it can't
+                # deadlock with the shards this session holds.
+                self._held[index] = acquired
+                self._replicated.add(index)
+                return acquired[1]
+        if self._held and max(self._held) > index:
+            if not self._dirty:
+                self._release_all()
+            else:
+                acquired = store.acquire(self._mode, blocking=False,
+                                         metrics=self.metrics)
+                if acquired is None:
+                    raise ShelveConflictError(
+                        "Shard %d is locked by another request, and "
+                        "waiting for it could deadlock." % index)
+                self._held[index] = acquired
+                return acquired[1]
+        self._held[index] = store.acquire(self._mode, metrics=self.metrics)
+        if self._mode == 'n':
+            # The shard was truncated.
+            self._dirty.add(index)
+        return self._held[index][1]
+
+    def _handles(self):
+        return [self._handle(i) for i in range(len(self._stores))]
+
+    def _handle_for(self, key, write=False):
+        return self._handle(self._index(key), write)
+
+    def _write_session(self, keys):
+        """Return a session that holds the write lock for ``keys``.
+
+        A writable session is used as is.  Otherwise any read locks are
+        released (this thread would deadlock waiting for the write lock
+        while holding them; the session locks them again when it's next
+        used) and a new session is returned, which the caller has to
+        close as soon as it's done.
+
+        """
+        if self._mode is None:
+            raise ValueError("The shelve session is closed.")
+        if self.writable:
+            db = self
+        else:
+            self._release_all()
+            db = _ShelveSession(self._stores, metrics=self.metrics)
+            db.open('c', lazy=True)
+        try:
+            db._lock_keys(keys)
+        except:
+            if db is not self:
+                db.close()
+            raise
+        return db
+
+    def _apply(self, keys, func):
+        """Call ``func(db)`` with the write lock held for ``keys``.
+
+        In write behind mode the call is queued instead, and a
+        WriteFuture for its result is returned.
+
+        """
+        if self._write_behind:
+            future = self._queue.submit(keys, func)
+            future._session = self
+            self._futures.append(future)
+            return future
+        db = self._write_session(keys)
+        try:
+            return func(db)
+        finally:
+            if db is not self:
+                db.close()
+
+    def flush(self, timeout=None):
+        """Wait for the writes this session queued to be applied.
+
+        This only does something in write behind mode.  Raises the error
+        of the first queued write that failed, if any.  Any read locks the
+        session holds are released while waiting, see WriteFuture.result.
+
+        """
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result(timeout)
+
+    def get_many(self, keys):
+        """Return a dict of the values of ``keys`` that exist.
+
+        Every shard involved is locked (in order) before any key is read,
+        so the values are a consistent snapshot, and values are only
+        deserialized once all the records have been read.
+
+        """
+        self._lock_keys(keys)
+        records = {}
+        values = {}
+        for key in keys:
+            index = self._index(key)
+            handle = self._handle(index)
+            if key in handle.cache:
+                values[key] = handle[key]
+                continue
+            cache = self._read_cache(index)
+            if cache is not None:
+                try:
+                    values[key] = cache.get(key, handle.generation)
+                    continue
+                except KeyError:
+                    pass
+            try:
+                records[key] = handle.get_raw(key)
+            except KeyError:
+                pass
+        for key, data in records.items():
+            index = self._index(key)
+            handle = self._held[index][1]
+            value = values[key] = handle.load(key, data)
+            cache = self._read_cache(index)
+            if cache is not None and not handle.writeback:
+                cache.put(key, value, handle.generation)
+        return values
+
+    def set_many(self, mapping):
+        """Store every item of ``mapping``.
+
+        The values are serialized before any lock is taken, and then written
+        under a single write lock.  Like ``update``, this only holds the
+        write lock for the duration of the call if the db was opened for
+        reading.
+
+        """
+        items = dict(mapping)
+        records = dict((key, self._stores[self._index(key)].codec.dumps(value))
+                       for key, value in items.items())
+
+        def set_many(db):
+            for key in items:
+                db._handle(db._index(key), write=True).set_raw(
+                    key, records[key], items[key])
+        return self._apply(items, set_many)
+
+    def _lock_keys(self, keys):
+        # Lock the shards needed for keys in ascending order up front,
+        # rather than in whatever order the keys happen to be used.
+        for index in sorted(set(self._index(key) for key in keys)):
+            self._handle(index)
+
+    def hash(self, name):
+        """Return a dict like view of the hash stored under ``name``.
+
+        Each field of a hash is stored as a record of its own, so reading
+        or updating a few fields doesn't deserialize or rewrite the rest.
+
+        """
+        return _Hash(self, name)
+
+    def put_stream(self, key, source, chunk_size=_BLOB_CHUNK_SIZE):
+        """Store the bytes of ``source`` as the blob ``key``.
+
+        ``source`` is a file like object or an iterable of byte strings.
+        It's stored in chunks of ``chunk_size`` bytes as it's read, so it
+        never has to be in memory all at once.  Blobs are kept apart from
+        the other keys, they're read with ``open_stream``.  Like
+        ``update``, this only holds the write lock for the duration of the
+        call if the db was opened for reading (and doesn't go through the
+        queue in write behind mode).  Returns the size of the blob.
+
+        The chunks are written under keys of their own, and only once
+        they've all been written is the blob switched over to them, so if
+        reading ``source`` fails the blob is left as it was.
+
+        """
+        name = _blob_key(key)
+        nonce = uuid.uuid4().hex
+        db = self._write_session([name])
+        try:
+            handle = db._handle(db._index(name), write=True)
+            old = handle.get(name)
+            size = 0
+            count = 0
+            try:
+                for chunk in _chunks(source, chunk_size):
+                    handle.set_uncached(_blob_key(key, count, nonce),
+                                        _RawSerializer.record(chunk))
+                    size += len(chunk)
+                    count += 1
+            except:
+                for i in range(count):
+                    handle.del_uncached(_blob_key(key, i, nonce))
+                raise
+            handle[name] = {'size': size, 'chunks': count, 'nonce': nonce}
+            if old is not None:
+                _delete_chunks(handle, key, old)
+            return size
+        finally:
+            if db is not self:
+                db.close()
+
+    def open_stream(self, key):
+        """Return a file like object that reads the blob ``key``.
+
+        The blob is read a chunk at a time, through this object, so it
+        has to stay open until the blob has been read.  Iterating over the
+        blob yields its chunks.  Raises KeyError if there's no such blob.
+
+        """
+        name = _blob_key(key)
+        return _BlobReader(self, key, self[name])
+
+    def delete_stream(self, key):
+        """Delete the blob ``key``, like ``del db[key]`` for blobs."""
+        name = _blob_key(key)
+
+        def delete_stream(db):
+            handle = db._handle(db._index(name), write=True)
+            _delete_chunks(handle, key, handle[name])
+            del handle[name]
+        return self._apply([name], delete_stream)
+
+    def incr(self, key, n=1):
+        """Add ``n`` to the number stored at ``key`` and return the result.
+
+        A missing key counts as 0.  Like the other atomic operations
+        (``setdefault``, ``update`` and ``cas``), this only holds the write
+        lock for the duration of the operation when the db was opened for
+        reading.
+
+        """
+        def incr(db):
+            value = db.get(key, 0) + n
+            db[key] = value
+            return value
+        return self._apply([key], incr)
+
+    def setdefault(self, key, default=None):
+        def setdefault(db):
+            try:
+                return db[key]
+            except KeyError:
+                db[key] = default
+                return default
+        return self._apply([key], setdefault)
+
+    def update(self, *args, **kwargs):
+        items = dict(*args, **kwargs)
+
+        def update(db):
+            for key in items:
+                db[key] = items[key]
+        return self._apply(items, update)
+
+    def cas(self, key, expected, new):
+        """Set ``key`` to ``new`` if its current value equals ``expected``.
+
+        Returns True if the value was set.  A missing key never matches.
+
+        """
+        def cas(db):
+            try:
+                current = db[key]
+            except KeyError:
+                return False
+            if current != expected:
+                return False
+            db[key] = new
+            return True
+        return self._apply([key], cas)
+
+    def sync(self):
+        for index in sorted(self._held):
+            self._held[index][1].sync()
+
+    def keys(self):
+        # Hash fields and blobs are only reached through their own views.
+        return [key for key in self._all_keys()
+                if not key.startswith((_HASH_PREFIX, _BLOB_PREFIX))]
+
+    def _all_keys(self):
+        keys = []
+        for handle in self._handles():
+            keys.extend(handle.keys())
+        return keys
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def _read_cache(self, index):
+        # Writers don't use the cache, they may modify what they read.
+        if self.writable:
+            return None
+        # A replica's values are cached by its own versions.
+        if index in self._replicated:
+            return self._stores[index].replica.store.cache
+        return self._stores[index].cache
+
+    def __contains__(self, key):
+        index = self._index(key)
+        handle = self._handle(index)
+        cache = self._read_cache(index)
+        if cache is not None and cache.has(key, handle.generation):
+            return True
+        return key in handle
+
+    def __getitem__(self, key):
+        index = self._index(key)
+        handle = self._handle(index)
+        cache = self._read_cache(index)
+        if cache is None:
+            return handle[key]
+        try:
+            return cache.get(key, handle.generation)
+        except KeyError:
+            value = handle[key]
+            cache.put(key, value, handle.generation)
+            return value
+
+    def __setitem__(self, key, value):
+        if self._write_behind:
+            self._apply([key], lambda db: db.__setitem__(key, value))
+        else:
+            self._handle_for(key, write=True)[key] = value
+
+    def __delitem__(self, key):
+        if self._write_behind:
+            self._apply([key], lambda db: db.__delitem__(key))
+        else:
+            del self._handle_for(key, write=True)[key]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+
+class _Shelf(shelve.Shelf):
+    """A shelf on a backend's db, with access to the serialized records.
+
+    Values are serialized by ``codec`` rather than always pickled.  With
+    writeback, only the cached values whose records have changed since
+    they were read (or written) are written back.
+
+    The writeback cache can be bounded by ``max_entries`` values or
+    ``max_bytes`` of records (0 means no limit).  When it grows past
+    either, the least recently used values are written back if they've
+    changed and then dropped from the cache.
+
+    Only ``writable`` handles write anything back, the cached values of
+    a reader's handle are just dropped.
+
+    """
+    def __init__(self, db, codec, writeback=False, max_entries=0,
+                 max_bytes=0, writable=True):
+        shelve.Shelf.__init__(self, db, writeback=writeback)
+        self.codec = codec
+        self.writable = writable
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Whether anything has been written through the shelf.
+        self.modified = False
+        # What's been read and written since the handle was checked out.
+        self.metrics = _Metrics()
+        self.drop_cache()
+
+    def __getitem__(self, key):
+        try:
+            value = self.cache.pop(key)
+        except KeyError:
+            return self.load(key, self.get_raw(key))
+        # Move the key to the most recently used end.
+        self.cache[key] = value
+        return value
+
+    def load(self, key, data):
+        """Deserialize ``data``, the record of ``key``."""
+        value = self.codec.loads(data)
+        if self.writeback:
+            self._cache_value(key, value, data)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set_raw(key, self.codec.dumps(value), value)
+
+    def __delitem__(self, key):
+        self.del_uncached(key)
+
+    def sync(self):
+        if self.writeback and self.writable:
+            for key, value in self.cache.items():
+                self._write_back(key, value)
+        self.drop_cache()
+        if hasattr(self.dict, 'sync'):
+            self.dict.sync()
+
+    def drop_cache(self):
+        """Forget the values kept for writeback, without writing them."""
+        self.cache = collections.OrderedDict()
+        # key -> (digest, size) of the record each cached value was read
+        # from or last written as.
+        self._records = {}
+        self._cache_bytes = 0
+
+    def _cache_value(self, key, value, data):
+        self._uncache(key)
+        self.cache[key] = value
+        self._records[key] = (_digest(data), len(data))
+        self._cache_bytes += len(data)
+        while len(self.cache) > 1 and (
+                (self.max_entries and len(self.cache) > self.max_entries) or
+                (self.max_bytes and self._cache_bytes > self.max_bytes)):
+            key, value = self.cache.popitem(last=False)
+            if self.writable:
+                self._write_back(key, value)
+            self._cache_bytes -= self._records.pop(key)[1]
+
+    def _uncache(self, key):
+        self.cache.pop(key, None)
+        if key in self._records:
+            self._cache_bytes -= self._records.pop(key)[1]
+
+    def _write_back(self, key, value):
+        data = self.codec.dumps(value)
+        if _digest(data) != self._records[key][0]:
+            self.dict[self._dbkey(key)] = data
+            self.modified = True
+            self.metrics.keys_written += 1
+            self.metrics.bytes_written += len(data)
+
+    def _dbkey(self, key):
+        # Python 3 shelves encode their keys.
+        keyencoding = getattr(self, 'keyencoding', None)
+        if keyencoding is None:
+            return key
+        return key.encode(keyencoding)
+
+    def get_raw(self, key):
+        """Return the record of ``key``."""
+        data = self.dict[self._dbkey(key)]
+        self.metrics.keys_read += 1
+        self.metrics.bytes_read += len(data)
+        return data
+
+    def set_raw(self, key, data, value):
+        """Store ``data``, the record of ``value``, under ``key``."""
+        self.set_uncached(key, data)
+        if self.writeback:
+            self._cache_value(key, value, data)
+
+    def set_uncached(self, key, data):
+        """Store the record ``data`` without keeping its value around."""
+        self._uncache(key)
+        self.dict[self._dbkey(key)] = data
+        self.modified = True
+        self.metrics.keys_written += 1
+        self.metrics.bytes_written += len(data)
+
+    def del_uncached(self, key):
+        del self.dict[self._dbkey(key)]
+        self._uncache(key)
+        self.modified = True
+        self.metrics.keys_deleted += 1
+
+
+def _digest(data):
+    return hashlib.sha1(data).digest()
+
+
+class _DbmBackend(object):
+    """dbm files, of whichever kind anydbm picks.
+
+    A backend is created with the filename of the db and provides:
+
+    * ``lock_reads`` - whether readers take the read lock.  Handles of a
+      backend that doesn't lock reads have to see every write as soon as
+      it's been synced.
+    * ``open(flag)`` - open the db, returning a mapping of keys to
+      serialized values like the ones ``dbm.open`` returns.  Writes are
+      flushed by its ``sync`` and ``close`` methods, if it has them.
+    * ``begin_read(db)`` - called when a reader is checked out, if reads
+      aren't locked.  Returns the write generation the reader sees.
+    * ``begin_write(db)`` - called when a writer is checked out, once the
+      write lock is held.
+    * ``end_read(db)`` - called whenever a handle is checked in without
+      having been written to.
+
+    A dbm handle caches the file's index, so reads have to be locked
+    against writers, and a handle has to be reopened once anyone else has
+    written to the file.
+
+    """
+    lock_reads = True
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._dbm_type = None
+
+    def open(self, flag):
+        if self._dbm_type is None:
+            self._dbm_type = whichdb(self.filename)
+        if self._dbm_type in ('gdbm', 'dbm.gnu'):
+            # gdbm takes its own lock when the file is opened, which
+            # would stop a writer from opening the file while a pooled
+            # reader still has it open.  Access is already serialized
+            # by _FileLock.
+            flag += 'u'
+        return dbm.open(self.filename, flag)
+
+    def begin_read(self, db):
+        return None
+
+    def begin_write(self, db):
+        pass
+
+    def end_read(self, db):
+        pass
+
+
+class _SqliteBackend(object):
+    """A SQLite db in WAL mode.
+
+    Every reader reads from a snapshot of the db, so readers don't take
+    the read lock at all: they don't wait for a writer, and a writer
+    doesn't wait for them.  Writers are still serialized by the write
+    lock.
+
+    """
+    lock_reads = False
+
+    def __init__(self, filename):
+        if sqlite3 is None:
+            raise RuntimeError("The sqlite backend needs the sqlite3 "
+                               "module.")
+        self.filename = filename
+        self._created = False
+
+    def open(self, flag):
+        # The first handle a process opens (the store's "touch") makes
+        # sure the tables exist, the others don't have to check.
+        create = not self._created and flag != 'r'
+        db = _SqliteDict(self.filename, flag, create)
+        if create:
+            self._created = True
+        return db
+
+    def begin_read(self, db):
+        return db.begin_read()
+
+    def begin_write(self, db):
+        pass
+
+    def end_read(self, db):
+        db.end_read()
+
+
+class _SqliteDict(MutableMapping):
+    """A dbm like mapping of byte strings, stored in a SQLite db.
+
+    Writes are made in a transaction that's committed by ``sync`` (or
+    ``close``), which also increments the write generation stored in the
+    db if anything was written.  A reader's snapshot, and the generation
+    it's from, is taken by ``begin_read``.  The tables are only created
+    if ``create`` is true.
+
+    """
+    def __init__(self, filename, flag='c', create=False):
+        self._conn = sqlite3.connect(filename, isolation_level=None,
+                                     check_same_thread=False)
+        self._readonly = flag == 'r'
+        self._writing = False
+        # Whether anything has been written since the last sync.
+        self._dirty = False
+        self._reading = False
+        if self._readonly:
+            return
+        # In WAL mode a commit is only lost if the machine crashes, not
+        # if the process does.
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        if create:
+            self._create()
+        if flag == 'n':
+            self._begin_write()
+            self._conn.execute('DELETE FROM shelf')
+            self._dirty = True
+            self.sync()
+
+    def _create(self):
+        # Checking first means the write lock is only taken if the tables
+        # really are missing.
+        if self._conn.execute("SELECT 1 FROM sqlite_master WHERE "
+                              "type = 'table' AND name = 'generation'"
+                              ).fetchone() is not None:
+            return
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._begin_write()
+        self._conn.execute('CREATE TABLE IF NOT EXISTS shelf '
+                           '(key BLOB PRIMARY KEY, value BLOB NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS generation '
+                           '(generation INTEGER NOT NULL)')
+        self._conn.execute('INSERT INTO generation SELECT 0 WHERE NOT '
+                           'EXISTS (SELECT 1 FROM generation)')
+        self.sync()
+
+    def _begin_write(self):
+        if self._readonly:
+            raise ValueError("The db was opened read only.")
+        if not self._writing:
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._writing = True
+
+    def begin_read(self):
+        """Start reading from a snapshot, return its write generation."""
+        self._conn.execute('BEGIN')
+        self._reading = True
+        # The snapshot is taken by the first read.
+        return self._conn.execute(
+            'SELECT generation FROM generation').fetchone()[0]
+
+    def end_read(self):
+        if self._reading:
+            self._reading = False
+            self._conn.execute('COMMIT')
+
+    def __getitem__(self, key):
+        row = self._conn.execute('SELECT value FROM shelf WHERE key = ?',
+                                 (sqlite3.Binary(key),)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return bytes(row[0])
+
+    def __setitem__(self, key, value):
+        self._begin_write()
+        self._conn.execute('INSERT OR REPLACE INTO shelf (key, value) '
+                           'VALUES (?, ?)',
+                           (sqlite3.Binary(key), sqlite3.Binary(value)))
+        self._dirty = True
+
+    def __delitem__(self, key):
+        self._begin_write()
+        cursor = self._conn.execute('DELETE FROM shelf WHERE key = ?',
+                                    (sqlite3.Binary(key),))
+        if not cursor.rowcount:
+            raise KeyError(key)
+        self._dirty = True
+
+    def __contains__(self, key):
+        row = self._conn.execute('SELECT 1 FROM shelf WHERE key = ?',
+                                 (sqlite3.Binary(key),)).fetchone()
+        return row is not None
+
+    def keys(self):
+        return [bytes(row[0])
+                for row in self._conn.execute('SELECT key FROM shelf')]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM shelf').fetchone()[0]
+
+    def sync(self):
+        if self._writing:
+            if self._dirty:
+                self._conn.execute('UPDATE generation '
+                                   'SET generation = generation + 1')
+                self._dirty = False
+            self._conn.execute('COMMIT')
+            self._writing = False
+
+    def close(self):
+        self.sync()
+        self._conn.close()
+
+
+class _LogBackend(object):
+    """An append only log of records, with a memory mapped hash index.
+
+    Writers only append to the log (and update the index in place), and
+    readers don't take the read lock, they look keys up in the index as
+    of the log length that was published when they started.
+
+    """
+    lock_reads = False
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def open(self, flag):
+        return _LogDict(self.filename, flag)
+
+    def begin_read(self, db):
+        return db.begin_read()
+
+    def begin_write(self, db):
+        db.begin_write()
+
+    def end_read(self, db):
+        pass
+
+
+def _log_hash(key):
+    # 64 bits, the top 32 pick the key's first slot.
+    return (((zlib.crc32(key) & 0xffffffff) << 32) |
+            (zlib.adler32(key) & 0xffffffff))
+
+
+def _write_all(fileno, data):
+    while data:
+        data = data[os.write(fileno, data):]
+
+
+class _LogDict(MutableMapping):
+    """A dbm like mapping of byte strings, stored in an append only log.
+
+    The db is two files: ``filename`` is the index, a hash table of (key
+    hash, record offset) slots with linear probing, and ``filename`` +
+    '.log.N' is the log the records are appended to.  Every record points
+    back to the key's previous record, so a reader can find a key's value
+    as of the log length it started at, whatever has been appended since.
+
+    Readers map both files and never lock them.  Slots are updated in
+    place while a sequence counter in the index header is odd, and a
+    reader reads a slot again if the counter was odd or changed while it
+    was reading it.  Writes are appended to the log as they're made (with
+    a little buffering), but aren't published until ``sync``, which
+    updates the slots and only then publishes the new log length, so
+    readers never see them early.  When the index gets half full, or the
+    log is compacted, a new index is written and renamed over the old
+    one; readers notice the new file the next time they begin reading.
+
+    """
+    def __init__(self, filename, flag='c'):
+        self._filename = filename
+        self._readonly = flag == 'r'
+        # Key -> offset of its latest unpublished record.
+        self._pending = {}
+        # Records appended but not written to the log yet.
+        self._buffer = []
+        self._buffered = 0
+        # Bytes of records made dead by the unpublished ones.
+        self._pending_dead = 0
+        self._index = None
+        self._log_fd = None
+        self._log_map = None
+        self._log_size = 0
+        if not self._readonly and not os.path.exists(filename):
+            self._create()
+        self._load()
+        # Where the next record goes.
+        self._end = self._length
+        if flag == 'n':
+            self._replace(self._log_number + 1, [], self._generation + 1)
+
+    def _log_filename(self, number):
+        return '%s.log.%d' % (self._filename, number)
+
+    def _create(self):
+        # Several processes may be creating the db at the same time, only
+        # one of them gets to link its index into place.
+        try:
+            fileno = os.open(self._log_filename(0),
+                             os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            try:
+                _write_all(fileno, _LOG_MAGIC)
+            finally:
+                os.close(fileno)
+        tmp = self._write_index(0, len(_LOG_MAGIC), 0, [], 0)
+        try:
+            os.link(tmp, self._filename)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        finally:
+            os.unlink(tmp)
+
+    def _write_index(self, log_number, length, generation, entries, dead,
+                     extra=0):
+        """Write a new index of ``entries`` to a temporary file.
+
+        ``entries`` is a list of (key hash, record offset), the index is
+        made big enough to take ``extra`` more.  Returns the name of the
+        file.
+
+        """
+        num_slots = _LOG_MIN_SLOTS
+        while (len(entries) + extra) * 2 > num_slots:
+            num_slots *= 2
+        data = bytearray(_LOG_INDEX_HEADER.size + num_slots * _LOG_SLOT.size)
+        _LOG_INDEX_HEADER.pack_into(data, 0, _LOG_INDEX_MAGIC, 0, log_number,
+                                    length, generation, num_slots,
+                                    len(entries), dead)
+        for key_hash, offset in entries:
+            slot = (key_hash >> 32) % num_slots
+            while _LOG_SLOT.unpack_from(data, self._slot_position(slot))[1]:
+                slot = (slot + 1) % num_slots
+            _LOG_SLOT.pack_into(data, self._slot_position(slot), key_hash,
+                                offset)
+        tmp = '%s.%d.%d.tmp' % (self._filename, os.getpid(), id(self))
+        fileno = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            _write_all(fileno, bytes(data))
+        finally:
+            os.close(fileno)
+        return tmp
+
+    def _load(self, wait=True):
+        self._close_files()
+        while True:
+            fileno = os.open(self._filename,
+                             os.O_RDONLY if self._readonly else os.O_RDWR)
+            try:
+                self._inode = os.fstat(fileno).st_ino
+                # The map keeps its own descriptor of the file.
+                self._index = mmap.mmap(
+                    fileno, 0, access=mmap.ACCESS_READ if self._readonly
+                    else mmap.ACCESS_WRITE)
+            finally:
+                os.close(fileno)
+            self._read_header(wait)
+            try:
+                self._log_fd = os.open(
+                    self._log_filename(self._log_number),
+                    os.O_RDONLY if self._readonly else os.O_RDWR)
+                return
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            # The log was compacted in between, try the new index.
+            self._index.close()
+
+    def _close_files(self):
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+        if self._log_map is not None:
+            self._log_map.close()
+            self._log_map = None
+            self._log_size = 0
+        if self._log_fd is not None:
+            os.close(self._log_fd)
+            self._log_fd = None
+
+    def _sequence(self):
+        return _LOG_SEQUENCE.unpack_from(self._index, 8)[0]
+
+    def _stable(self, read, wait=True):
+        """Call ``read`` until the sequence counter says nothing was being
+        updated while it ran, and return the result.
+
+        A writer that dies half way through an update leaves the counter
+        odd until the next writer repairs the index, so readers only wait
+        for ``_LOG_STALL_SECONDS`` (not at all if ``wait`` is false) and
+        then read what's there.  That's still consistent: the header and
+        each slot are written in one go, and readers only follow records
+        below the published length.
+
+        """
+        deadline = None
+        while True:
+            sequence = self._sequence()
+            result = read()
+            if not sequence % 2 and self._sequence() == sequence:
+                return result
+            if deadline is None:
+                deadline = _timer() + (_LOG_STALL_SECONDS if wait else 0)
+            if _timer() >= deadline:
+                return result
+            time.sleep(0)
+
+    def _read_header(self, wait=True):
+        header = self._stable(
+            lambda: _LOG_INDEX_HEADER.unpack_from(self._index, 0), wait)
+        (magic, sequence, self._log_number, self._length, self._generation,
+         self._num_slots, self._used, self._dead) = header
+        if magic != _LOG_INDEX_MAGIC:
+            raise ValueError("%s isn't a log backend index." % self._filename)
+
+    def _slot_position(self, slot):
+        return _LOG_INDEX_HEADER.size + slot * _LOG_SLOT.size
+
+    def _slot(self, slot):
+        position = self._slot_position(slot)
+        if not self._readonly:
+            # Only the writer changes the slots.
+            return _LOG_SLOT.unpack_from(self._index, position)
+        return self._stable(
+            lambda: _LOG_SLOT.unpack_from(self._index, position))
+
+    def _read(self, offset, size):
+        if self._buffer and offset + size > self._end - self._buffered:
+            self._flush()
+        if offset + size > self._log_size:
+            if self._log_map is not None:
+                self._log_map.close()
+            self._log_size = os.fstat(self._log_fd).st_size
+            self._log_map = mmap.mmap(self._log_fd, self._log_size,
+                                      access=mmap.ACCESS_READ)
+        return self._log_map[offset:offset + size]
+
+    def _record(self, offset):
+        """Return the previous offset, key and value length of a record."""
+        return _LOG_RECORD.unpack(self._read(offset, _LOG_RECORD.size))
+
+    def _find(self, key):
+        """Return the slot of ``key`` and its latest record offset.
+
+        If the key isn't in the index, the offset is 0 and the slot is the
+        empty one it would go in.
+
+        """
+        key_hash = _log_hash(key)
+        slot = (key_hash >> 32) % self._num_slots
+        while True:
+            slot_hash, offset = self._slot(slot)
+            if not offset:
+                return slot, 0
+            if slot_hash == key_hash:
+                prev, key_size, value_size = self._record(offset)
+                if self._read(offset + _LOG_RECORD.size, key_size) == key:
+                    return slot, offset
+            slot = (slot + 1) % self._num_slots
+
+    def _lookup(self, key):
+        # The offset of the key's record as of the published length this
+        # handle is at, 0 if there isn't one.
+        offset = self._find(key)[1]
+        while offset >= self._length:
+            offset = self._record(offset)[0]
+        return offset
+
+    def begin_read(self, wait=True):
+        """Start reading the latest published log, return its generation."""
+        if os.stat(self._filename).st_ino != self._inode:
+            self._load(wait)
+        else:
+            self._read_header(wait)
+        return self._generation
+
+    def begin_write(self):
+        """Get ready to write, the caller must hold the write lock."""
+        self._pending = {}
+        self._buffer = []
+        self._buffered = 0
+        self._pending_dead = 0
+        # With the write lock held, nobody can be updating the index.
+        self.begin_read(wait=False)
+        if self._sequence() % 2:
+            self._repair()
+        if os.fstat(self._log_fd).st_size > self._length:
+            # Whatever a writer that died appended without publishing it.
+            os.ftruncate(self._log_fd, self._length)
+        self._end = self._length
+
+    def _append(self, key, value):
+        # Append a record of ``key`` (a deletion if ``value`` is None).
+        if self._readonly:
+            raise ValueError("The db was opened read only.")
+        prev = self._pending.get(key) or self._find(key)[1]
+        if prev:
+            key_size, value_size = self._record(prev)[1:]
+            if value_size != _LOG_DELETED:
+                self._pending_dead += _LOG_RECORD.size + key_size + value_size
+        if value is None:
+            record = _LOG_RECORD.pack(prev, len(key), _LOG_DELETED) + key
+            self._pending_dead += len(record)
+        else:
+            record = _LOG_RECORD.pack(prev, len(key), len(value)) + key + value
+        self._pending[key] = self._end
+        self._end += len(record)
+        self._buffer.append(record)
+        self._buffered += len(record)
+        if self._buffered >= _LOG_BUFFER_BYTES:
+            self._flush()
+
+    def _flush(self):
+        os.lseek(self._log_fd, self._end - self._buffered, os.SEEK_SET)
+        _write_all(self._log_fd, b''.join(self._buffer))
+        self._buffer = []
+        self._buffered = 0
+
+    def __getitem__(self, key):
+        offset = self._pending.get(key) or self._lookup(key)
+        if not offset:
+            raise KeyError(key)
+        prev, key_size, value_size = self._record(offset)
+        if value_size == _LOG_DELETED:
+            raise KeyError(key)
+        return self._read(offset + _LOG_RECORD.size + key_size, value_size)
+
+    def __setitem__(self, key, value):
+        self._append(key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._append(key, None)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def _live(self):
+        # (key hash, offset) of the latest record of every key that
+        # hasn't been deleted, as of this handle's published length.
+        for slot in range(self._num_slots):
+            key_hash, offset = self._slot(slot)
+            while offset >= self._length:
+                offset = self._record(offset)[0]
+            if offset and self._record(offset)[2] != _LOG_DELETED:
+                yield key_hash, offset
+
+    def keys(self):
+        keys = set()
+        for key_hash, offset in self._live():
+            key_size = self._record(offset)[1]
+            keys.add(self._read(offset + _LOG_RECORD.size, key_size))
+        for key, offset in self._pending.items():
+            if self._record(offset)[2] == _LOG_DELETED:
+                keys.discard(key)
+            else:
+                keys.add(key)
+        return list(keys)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def sync(self):
+        if not self._pending:
+            return
+        # Readers only follow offsets below the published length, so the
+        # records have to be in the log before they're published.
+        self._flush()
+        pending, self._pending = self._pending, {}
+        if (self._used + len(pending)) * 2 > self._num_slots:
+            self._grow(len(pending))
+        sequence = self._sequence()
+        _LOG_SEQUENCE.pack_into(self._index, 8, sequence + 1)
+        used = self._used
+        for key, offset in pending.items():
+            slot, prev = self._find(key)
+            if not prev:
+                used += 1
+            _LOG_SLOT.pack_into(self._index, self._slot_position(slot),
+                                _log_hash(key), offset)
+        _LOG_INDEX_HEADER.pack_into(
+            self._index, 0, _LOG_INDEX_MAGIC, sequence + 1, self._log_number,
+            self._end, self._generation + 1, self._num_slots, used,
+            self._dead + self._pending_dead)
+        _LOG_SEQUENCE.pack_into(self._index, 8, sequence + 2)
+        self._pending_dead = 0
+        self._read_header()
+        if self._dead * 2 > self._length > _LOG_COMPACT_MIN_BYTES:
+            self.compact()
+
+    def _repair(self):
+        # A writer died while updating the index, so some slots may point
+        # at records it never published.  Follow them back to the
+        # published length and write a new index of what's left.
+        entries = []
+        for slot in range(self._num_slots):
+            key_hash, offset = self._slot(slot)
+            while offset >= self._length:
+                offset = self._record(offset)[0]
+            if offset:
+                entries.append((key_hash, offset))
+        self._rename_index(self._write_index(
+            self._log_number, self._length, self._generation + 1, entries,
+            self._dead))
+
+    def _grow(self, extra):
+        # Make room for ``extra`` more keys.  The slots hold the key
+        # hashes, so nothing has to be read from the log.
+        entries = [self._slot(slot) for slot in range(self._num_slots)]
+        self._rename_index(self._write_index(
+            self._log_number, self._length, self._generation,
+            [entry for entry in entries if entry[1]], self._dead, extra))
+
+    def compact(self):
+        """Copy the live records to a new log, and drop the old one.
+
+        The caller must hold the write lock, and have nothing pending.
+
+        """
+        log_number = self._log_number + 1
+        fileno = os.open(self._log_filename(log_number),
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        entries = []
+        try:
+            # The records are written a buffer at a time, so the live db
+            # is never all in memory.
+            chunks = [_LOG_MAGIC]
+            buffered = length = len(_LOG_MAGIC)
+            for key_hash, offset in self._live():
+                prev, key_size, value_size = self._record(offset)
+                record = (_LOG_RECORD.pack(0, key_size, value_size) +
+                          self._read(offset + _LOG_RECORD.size,
+                                     key_size + value_size))
+                chunks.append(record)
+                entries.append((key_hash, length))
+                length += len(record)
+                buffered += len(record)
+                if buffered >= _LOG_BUFFER_BYTES:
+                    _write_all(fileno, b''.join(chunks))
+                    chunks = []
+                    buffered = 0
+            _write_all(fileno, b''.join(chunks))
+        finally:
+            os.close(fileno)
+        self._replace(log_number, entries, self._generation, length)
+
+    def _replace(self, log_number, entries, generation, length=None):
+        # Switch to a new log, holding ``entries``.
+        old_log = self._log_filename(self._log_number)
+        if length is None:
+            fileno = os.open(self._log_filename(log_number),
+                             os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            try:
+                _write_all(fileno, _LOG_MAGIC)
+            finally:
+                os.close(fileno)
+            length = len(_LOG_MAGIC)
+        self._rename_index(self._write_index(log_number, length, generation,
+                                             entries, 0))
+        self._end = length
+        # Readers that still have the old log open can keep reading it.
+        os.unlink(old_log)
+
+    def _rename_index(self, tmp):
+        os.rename(tmp, self._filename)
+        self._load()
+
+    def close(self):
+        self.sync()
+        self._close_files()
+
+
+class _SnapshotBackend(object):
+    """Copy on write versions of a dbm file.
+
+    Published versions are never written to again, so readers don't take
+    the read lock: a reader opens whichever version was published last
+    and keeps reading it, however many writers have published since.  A
+    writer copies the db the first time it writes, which makes writes
+    cost as much as the whole db, so this suits small, read mostly dbs.
+
+    """
+    lock_reads = False
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def open(self, flag):
+        return _SnapshotDict(self.filename, flag)
+
+    def begin_read(self, db):
+        return db.begin_read()
+
+    def begin_write(self, db):
+        db.begin_write()
+
+    def end_read(self, db):
+        db.rollback()
+
+
+class _SnapshotDict(MutableMapping):
+    """A dbm like mapping of byte strings, stored in versioned dbm files.
+
+    ``filename`` holds the number of the published version, and version N
+    is a dbm file named ``filename`` + '.vN', along with a lock file
+    ('.vN.lock').  A writer copies the published version to the next one,
+    writes to the copy, and ``sync`` publishes it by renaming a new
+    ``filename`` into place.  Readers hold a shared flock() on the lock
+    file of the version they're reading, and once a version has been
+    superseded, writers delete it as soon as they can lock its lock file
+    exclusively.  The lock file is deleted last, so a reader that finds
+    it still linked after locking it knows the data files are all there.
+
+    ``as_of`` is the modification time of ``filename`` when the version
+    being read was published.  A writer can set ``published_at`` before
+    ``sync`` to date the version it publishes, otherwise it's dated when
+    it's published.
+
+    """
+    def __init__(self, filename, flag='c'):
+        self._filename = filename
+        self._readonly = flag == 'r'
+        self.as_of = None
+        self.published_at = None
+        self._version = None
+        self._db = None
+        self._lock_fd = None
+        # The unpublished version being written to, if any.
+        self._writing = None
+        if not self._readonly and not os.path.exists(filename):
+            self._create()
+        self.begin_read()
+        if flag == 'n':
+            self._start_writing(empty=True)
+
+    def _base(self, version):
+        return '%s.v%d' % (self._filename, version)
+
+    def _lock_filename(self, version):
+        return self._base(version) + '.lock'
+
+    def _create(self):
+        # Several processes may be creating the db at the same time, only
+        # one of them gets to link its pointer into place.
+        if not os.path.exists(self._lock_filename(0)):
+            dbm.open(self._base(0), 'c').close()
+            os.close(os.open(self._lock_filename(0),
+                             os.O_WRONLY | os.O_CREAT, 0o666))
+        tmp = self._write_pointer(0)
+        try:
+            os.link(tmp, self._filename)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        finally:
+            os.unlink(tmp)
+
+    def _write_pointer(self, version):
+        tmp = '%s.%d.%d.tmp' % (self._filename, os.getpid(), id(self))
+        fileno = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            _write_all(fileno, ('%d' % version).encode('ascii'))
+        finally:
+            os.close(fileno)
+        if self.published_at is not None:
+            os.utime(tmp, (self.published_at, self.published_at))
+        self.as_of = os.stat(tmp).st_mtime
+        return tmp
+
+    def _published(self):
+        with open(self._filename, 'rb') as f:
+            self.as_of = os.fstat(f.fileno()).st_mtime
+            return int(f.read())
+
+    def begin_read(self):
+        """Start reading the latest published version, return its number."""
+        while True:
+            version = self._published()
+            if version == self._version or self._open_version(version):
+                return version
+
+    def _open_version(self, version):
+        # Returns False if the version was deleted before it was locked.
+        try:
+            fileno = os.open(self._lock_filename(version), os.O_RDONLY)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        try:
+            try:
+                fcntl.flock(fileno, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                # A writer is deleting it.
+                return False
+            if not os.fstat(fileno).st_nlink:
+                return False
+        except:
+            os.close(fileno)
+            raise
+        self._close_version()
+        self._version, self._lock_fd = version, fileno
+        return True
+
+    def _reader(self):
+        # The version is only opened once it's read, a writer that
+        # doesn't read anything only opens its copy.
+        if self._db is None:
+            self._db = dbm.open(self._base(self._version), 'r')
+        return self._db
+
+    def _close_version(self):
+        if self._db is not None:
+            _close_readonly(self._db)
+            self._db = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        self._version = None
+
+    def begin_write(self):
+        """Get ready to write, the caller must hold the write lock."""
+        if self._writing is None:
+            self.begin_read()
+
+    def _data_files(self, version):
+        # (path, suffix) of each of the version's dbm files, whatever
+        # suffixes the dbm module gave them.
+        base = self._base(version)
+        name = os.path.basename(base)
+        files = []
+        for entry in os.listdir(os.path.dirname(base) or os.curdir):
+            suffix = entry[len(name):]
+            if (entry.startswith(name) and suffix[:1] in ('', '.') and
+                    suffix != '.lock'):
+                files.append((base + suffix, suffix))
+        return files
+
+    def _remove(self, paths):
+        for path in paths:
+            try:
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _start_writing(self, empty=False):
+        if self._readonly:
+            raise ValueError("The db was opened read only.")
+        self.published_at = None
+        version = self._version + 1
+        # Whatever a writer that died before publishing left behind.
+        self._remove([path for path, suffix in self._data_files(version)] +
+                     [self._lock_filename(version)])
+        if not empty:
+            base = self._base(version)
+            for path, suffix in self._data_files(self._version):
+                shutil.copyfile(path, base + suffix)
+        self._writing = (version, dbm.open(self._base(version),
+                                           'n' if empty else 'w'))
+
+    def _target(self):
+        if self._writing is None:
+            self._start_writing()
+        return self._writing[1]
+
+    def rollback(self):
+        """Throw away anything written since the last ``sync``."""
+        if self._writing is not None:
+            version, db = self._writing
+            self._writing = None
+            db.close()
+            self._remove(path for path, suffix in self._data_files(version))
+
+    def __getitem__(self, key):
+        if self._writing is not None:
+            return self._writing[1][key]
+        return self._reader()[key]
+
+    def __setitem__(self, key, value):
+        self._target()[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        del self._target()[key]
+
+    def __contains__(self, key):
+        if self._writing is not None:
+            return key in self._writing[1]
+        return key in self._reader()
+
+    def keys(self):
+        if self._writing is not None:
+            return list(self._writing[1].keys())
+        return list(self._reader().keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def sync(self):
+        if self._writing is None:
+            return
+        version, db = self._writing
+        self._writing = None
+        db.close()
+        os.close(os.open(self._lock_filename(version),
+                         os.O_WRONLY | os.O_CREAT, 0o666))
+        os.rename(self._write_pointer(version), self._filename)
+        if not self._open_version(version):
+            raise RuntimeError("Version %d of %s was deleted before it "
+                               "could be read." % (version, self._filename))
+        self._collect(version)
+
+    def _collect(self, published):
+        # Delete the versions before ``published`` that nobody's reading.
+        directory = os.path.dirname(self._filename) or os.curdir
+        prefix = os.path.basename(self._filename) + '.v'
+        for name in os.listdir(directory):
+            if not (name.startswith(prefix) and name.endswith('.lock')):
+                continue
+            try:
+                version = int(name[len(prefix):-len('.lock')])
+            except ValueError:
+                continue
+            if version >= published:
+                continue
+            try:
+                fileno = os.open(os.path.join(directory, name), os.O_RDONLY)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            try:
+                try:
+                    fcntl.flock(fileno, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError) as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    # Still being read.
+                    continue
+                self._remove([path for path, suffix
+                              in self._data_files(version)] +
+                             [self._lock_filename(version)])
+            finally:
+                os.close(fileno)
+
+    def close(self):
+        self.sync()
+        self._close_version()
+
+
+def _close_readonly(db):
+    # dumbdbm rewrites its index file when it's closed, even if it was
+    # opened read only, which mustn't happen to a published version.
+    if getattr(db, '_index', None) is not None:
+        db._index = None
+    db.close()
+
+
+_BACKENDS = {
+    'dbm': _DbmBackend,
+    'sqlite': _SqliteBackend,
+    'log': _LogBackend,
+    'snapshot': _SnapshotBackend,
+}
+
+
+def _serializer(serializer, protocol):
+    # SHELVE_SERIALIZER is either the name of a serializer, or a
+    # serializer.  SHELVE_PROTOCOL only applies to pickle.
+    if hasattr(serializer, 'dumps'):
+        return serializer
+    if serializer == 'pickle':
+        return _PickleSerializer(protocol)
+    try:
+        return _SERIALIZERS[serializer]()
+    except KeyError:
+        raise ValueError("Unknown serializer %r, expected one of: %s" %
+                         (serializer, ', '.join(sorted(_SERIALIZERS))))
+
+
+class _PickleSerializer(object):
+    """Pickles, by default with the highest protocol there is.
+
+    A serializer has a ``tag``, a single byte stored at the start of each
+    record it writes (after a NUL) so the record can be read back whatever
+    the app's serializer is later on, and ``dumps`` and ``loads`` methods.
+    Pickles aren't tagged, so shelve itself can still read them.
+
+    """
+    tag = None
+
+    def __init__(self, protocol=None):
+        if protocol is None:
+            protocol = pickle.HIGHEST_PROTOCOL
+        self.protocol = protocol
+
+    def dumps(self, value):
+        return pickle.dumps(value, self.protocol)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class _MarshalSerializer(object):
+    """marshal, which is fast but only handles builtin types."""
+    tag = b'm'
+
+    def dumps(self, value):
+        return marshal.dumps(value)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+
+class _JsonSerializer(object):
+    """JSON, readable by anything.  Strings are read back as unicode."""
+    tag = b'j'
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data.decode('utf-8'))
+
+
+class _RawSerializer(object):
+    """Byte strings stored as they are, used for the chunks of blobs."""
+    tag = b'b'
+
+    @classmethod
+    def record(cls, data):
+        return _SERIALIZER_TAG + cls.tag + data
+
+    def dumps(self, value):
+        return value
+
+    def loads(self, data):
+        return data
+
+
+_SERIALIZERS = {
+    'pickle': _PickleSerializer,
+    'marshal': _MarshalSerializer,
+    'json': _JsonSerializer,
+}
+
+
+def _compressor(compressor):
+    # SHELVE_COMPRESS is None, or the name of a compressor.
+    if compressor is None:
+        return None
+    try:
+        return _COMPRESSORS[compressor]()
+    except KeyError:
+        raise ValueError("Unknown compressor %r, expected one of: %s" %
+                         (compressor, ', '.join(sorted(_COMPRESSORS))))
+
+
+class _ZlibCompressor(object):
+    tag = b'z'
+
+    def compress(self, data):
+        return zlib.compress(data)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class _LzmaCompressor(object):
+    """lzma, which compresses better than zlib but is a lot slower."""
+    tag = b'x'
+
+    def __init__(self):
+        if lzma is None:
+            raise RuntimeError("lzma compression needs the lzma module.")
+
+    def compress(self, data):
+        return lzma.compress(data)
+
+    def decompress(self, data):
+        return lzma.decompress(data)
+
+
+_COMPRESSORS = {
+    'zlib': _ZlibCompressor,
+    'lzma': _LzmaCompressor,
+}
+
+
+class _Codec(object):
+    """Turns values into records and back.
+
+    Values are written by the app's serializer, but a record written by
+    any of the serializers can be read back.  With a ``compressor``,
+    records of at least ``min_bytes`` are compressed, and stored with the
+    compressor's tag in front of them if that made them smaller.
+
+    """
+    def __init__(self, serializer, compressor, min_bytes, stats):
+        self.serializer = serializer
+        self._serializers = dict((cls.tag, cls()) for cls in
+                                 _SERIALIZERS.values() if cls.tag is not None)
+        self._serializers[_RawSerializer.tag] = _RawSerializer()
+        self.compressor = compressor
+        self._min_bytes = min_bytes
+        self._stats = stats
+        # Compressed records can be read whatever the compressor is now,
+        # as long as the module they need is there.
+        self._compressors = {}
+        for cls in _COMPRESSORS.values():
+            if cls is not _LzmaCompressor or lzma is not None:
+                self._compressors[cls.tag] = cls()
+        tag = serializer.tag
+        if tag is None:
+            if not isinstance(serializer, _PickleSerializer):
+                raise ValueError("Only pickles are stored untagged, the "
+                                 "serializer needs a tag.")
+        else:
+            if len(tag) != 1:
+                raise ValueError("A serializer's tag must be one byte, "
+                                 "not %r." % (tag,))
+            known = self._serializers.get(tag, self._compressors.get(tag))
+            if known is not None and type(known) is not type(serializer):
+                raise ValueError("The serializer tag %r is already used by "
+                                 "%s." % (tag, type(known).__name__))
+            self._serializers[tag] = serializer
+
+    def dumps(self, value):
+        data = self.serializer.dumps(value)
+        if self.serializer.tag is not None:
+            data = _SERIALIZER_TAG + self.serializer.tag + data
+        if self.compressor is None or len(data) < self._min_bytes:
+            return data
+        start = _timer()
+        compressed = self.compressor.compress(data)
+        seconds = _timer() - start
+        saved = len(data) - len(compressed) - 2
+        if saved <= 0:
+            self._stats.add(compress_seconds=seconds)
+            return data
+        self._stats.add(compressed_records=1, compress_bytes_in=len(data),
+                        compress_bytes_saved=saved, compress_seconds=seconds)
+        return _SERIALIZER_TAG + self.compressor.tag + compressed
+
+    def loads(self, data):
+        if data[:1] != _SERIALIZER_TAG:
+            return pickle.loads(data)
+        compressor = self._compressors.get(data[1:2])
+        if compressor is not None:
+            start = _timer()
+            data = compressor.decompress(data[2:])
+            self._stats.add(decompressed_records=1,
+                            decompress_seconds=_timer() - start)
+            return self.loads(data)
+        try:
+            serializer = self._serializers[data[1:2]]
+        except KeyError:
+            raise ValueError("The record was written by an unknown "
+                             "serializer, tagged %r." % (data[1:2],))
+        return serializer.loads(data[2:])
+
+
+class _Stats(object):
+    """Counters shared by every request of an app, see get_stats."""
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._counters = dict((name, 0) for name in _STATS_COUNTERS)
+        self._histograms = dict((name, [0] * (len(_HISTOGRAM_BOUNDS) + 1))
+                                for name in _STATS_HISTOGRAMS)
+
+    def add(self, **counts):
+        with self._mutex:
+            for name, n in counts.items():
+                self._counters[name] += n
+                if name in self._histograms:
+                    bucket = bisect.bisect_left(_HISTOGRAM_BOUNDS, n)
+                    self._histograms[name][bucket] += 1
+
+    def snapshot(self):
+        with self._mutex:
+            stats = dict(self._counters)
+            stats['histograms'] = dict(
+                (name, list(zip(_HISTOGRAM_BOUNDS + (None,), buckets)))
+                for name, buckets in self._histograms.items())
+            return stats
+
+
+class _Metrics(object):
+    """What a session (or a handle) did with the db.
+
+    The attributes are the names in _METRICS, see get_stats.
+
+    """
+    def __init__(self):
+        for name in _METRICS:
+            setattr(self, name, 0)
+
+    def add(self, **counts):
+        for name, n in counts.items():
+            setattr(self, name, getattr(self, name) + n)
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in _METRICS)
+
+
+class _Hash(MutableMapping):
+    """A dict stored as one record per field.
+
+    Fields are stored under ``_HASH_PREFIX + name + '\\x00' + field``.
+    Listing the fields has to scan every key in the db.
+
+    """
+    def __init__(self, db, name):
+        self._db = db
+        self.name = name
+        self._prefix = '%s%s\x00' % (_HASH_PREFIX, name)
+
+    def _key(self, field):
+        return self._prefix + field
+
+    def get_many(self, fields):
+        """Return a dict of the values of ``fields`` that exist."""
+        start = len(self._prefix)
+        values = self._db.get_many([self._key(field) for field in fields])
+        return dict((key[start:], value) for key, value in values.items())
+
+    def incr(self, field, n=1):
+        """Atomically add ``n`` to ``field``, see _ShelveSession.incr."""
+        return self._db.incr(self._key(field), n)
+
+    def incr_many(self, counts):
+        """Atomically add each of the ``counts`` to its field.
+
+        ``counts`` maps fields to the amount to add.  All the fields are
+        updated under a single write lock.
+
+        """
+        keys = dict((self._key(field), n) for field, n in counts.items())
+
+        def incr_many(db):
+            for key, n in keys.items():
+                db[key] = db.get(key, 0) + n
+        return self._db._apply(keys, incr_many)
+
+    def __getitem__(self, field):
+        return self._db[self._key(field)]
+
+    def __setitem__(self, field, value):
+        self._db[self._key(field)] = value
+
+    def __delitem__(self, field):
+        del self._db[self._key(field)]
+
+    def __contains__(self, field):
+        return self._key(field) in self._db
+
+    def __iter__(self):
+        start = len(self._prefix)
+        return iter([key[start:] for key in self._db._all_keys()
+                     if key.startswith(self._prefix)])
+
+    def __len__(self):
+        return sum(1 for field in self)
+
+
+def _blob_key(key, chunk=None, nonce=None):
+    # A blob's chunks are named after the upload they were written by, so
+    # a new upload doesn't overwrite the chunks of the current one.  Blobs
+    # stored before that have no nonce.
+    if chunk is None:
+        return '%s%s\x00' % (_BLOB_PREFIX, key)
+    if nonce is None:
+        return '%s%s\x00%d' % (_BLOB_PREFIX, key, chunk)
+    return '%s%s\x00%s.%d' % (_BLOB_PREFIX, key, nonce, chunk)
+
+
+def _delete_chunks(handle, key, blob):
+    for i in range(blob['chunks']):
+        handle.del_uncached(_blob_key(key, i, blob.get('nonce')))
+
+
+def _chunks(source, size):
+    """Yield the bytes of ``source`` in chunks of ``size`` bytes.
+
+    ``source`` is a file like object or an iterable of byte strings.  The
+    last chunk may be shorter.
+
+    """
+    if hasattr(source, 'read'):
+        read = source.read
+        source = iter(lambda: read(size), b'')
+    buffered = []
+    length = 0
+    for data in source:
+        buffered.append(data)
+        length += len(data)
+        while length >= size:
+            data = b''.join(buffered)
+            yield data[:size]
+            buffered = [data[size:]]
+            length -= size
+    if length:
+        yield b''.join(buffered)
+
+
+class _BlobReader(object):
+    """A file like view of a blob, which reads it a chunk at a time."""
+    def __init__(self, db, key, blob):
+        self._db = db
+        self._key = key
+        self.size = blob['size']
+        self._chunks = blob['chunks']
+        self._nonce = blob.get('nonce')
+        self._next = 0
+        self._buffer = b''
+
+    def _read_chunk(self):
+        # Returns an empty string at the end of the blob.
+        if self._next >= self._chunks:
+            return b''
+        key = _blob_key(self._key, self._next, self._nonce)
+        self._next += 1
+        # Skip the serializer tag.
+        return self._db._handle_for(key).get_raw(key)[2:]
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            chunk = self._read_chunk()
+            if not chunk:
+                break
+            chunks.append(chunk)
+            length += len(chunk)
+        data = b''.join(chunks)
+        if size < 0:
+            self._buffer = b''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+    def __iter__(self):
+        if self._buffer:
+            chunk, self._buffer = self._buffer, b''
+            yield chunk
+        while True:
+            chunk = self._read_chunk()
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self._next = self._chunks
+        self._buffer = b''
+
+
+class WriteFuture(object):
+    """The eventual result of a write queued in write behind mode."""
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._error = None
+        # The session that queued the write.
+        self._session = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the write to be applied and return its result.
+
+        If the write failed, its exception is raised.  If it isn't
+        applied within ``timeout`` seconds, ShelveTimeoutError is raised.
+
+        When called from the thread that queued the write, the read locks
+        that thread's session holds are released first (the session locks
+        them again when it's next used); the write couldn't be applied
+        while they're held.
+
+        """
+        session = self._session
+        if (session is not None and not self._event.is_set() and
+                session._thread is threading.current_thread()):
+            session._release_all()
+        if not self._event.wait(timeout):
+            raise ShelveTimeoutError("The queued write wasn't applied "
+                                     "within %s seconds." % timeout)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def _set(self, result, error):
+        self._result = result
+        self._error = error
+        self._event.set()
+
+
+class AsyncShelve(object):
+    """A session for coroutines, see get_shelve_async.
+
+    Every method returns an awaitable for the result of the session
+    method of the same name, which is called in the event loop's default
+    executor.  Calls are applied one at a time.
+
+    """
+    def __init__(self, session):
+        self.session = session
+        self._mutex = threading.Lock()
+
+    def call(self, func, *args):
+        """Return an awaitable for ``func(session, *args)``.
+
+        For anything there isn't a method for, e.g.
+        ``await db.call(lambda db: list(db.hash('words').items()))``.
+
+        """
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(None, self._call, func, args)
+
+    def _call(self, func, args):
+        with self._mutex:
+            session = self.session
+            # The session is used from this thread for now, see
+            # WriteFuture.result.
+            thread, session._thread = (session._thread,
+                                       threading.current_thread())
+            try:
+                return func(session, *args)
+            finally:
+                session._thread = thread
+
+    def open(self, mode='c', max_staleness=None):
+        """Return an awaitable that locks the db and resolves to ``self``.
+        """
+        return self.call(_open_session, mode, max_staleness, self)
+
+    def close(self):
+        return self.call(_ShelveSession.close)
+
+    def get(self, key, default=None):
+        return self.call(_ShelveSession.get, key, default)
+
+    def set(self, key, value):
+        return self.call(_ShelveSession.__setitem__, key, value)
+
+    def delete(self, key):
+        return self.call(_ShelveSession.__delitem__, key)
+
+    def contains(self, key):
+        return self.call(_ShelveSession.__contains__, key)
+
+    def get_many(self, keys):
+        return self.call(_ShelveSession.get_many, keys)
+
+    def set_many(self, mapping):
+        return self.call(_ShelveSession.set_many, mapping)
+
+    def incr(self, key, n=1):
+        return self.call(_ShelveSession.incr, key, n)
+
+    def flush(self, timeout=None):
+        return self.call(_ShelveSession.flush, timeout)
+
+
+def _open_session(session, mode, max_staleness, db):
+    # Every store is locked now, rather than when a key is first used.
+    session.open(mode, lazy=True, max_staleness=max_staleness)
+    session._handles()
+    return db
+
+
+class _AsyncOpen(object):
+    """What get_shelve_async returns."""
+    def __init__(self, db, mode, max_staleness):
+        self._db = db
+        self._mode = mode
+        self._max_staleness = max_staleness
+
+    def __await__(self):
+        return self._db.open(self._mode, self._max_staleness).__await__()
+
+    def __aenter__(self):
+        return self._db.open(self._mode, self._max_staleness)
+
+    def __aexit__(self, exc_type, exc_value, traceback):
+        return self._db.close()
+
+
+class _WriteQueue(object):
+    """Writes queued by requests, applied in batches by a single thread.
+
+    Everything that's queued while a batch is being applied goes into
+    the next batch, which is applied under a single write lock (per
+    shard) and flushed with a single sync.  A batch's futures are only
+    completed once it's been flushed and the lock released.
+
+    """
+    def __init__(self, stores):
+        self._stores = stores
+        self._cond = threading.Condition(threading.Lock())
+        self._pending = []
+        self._busy = False
+        self._thread = None
+        self._pid = None
+        atexit.register(self.join)
+
+    def submit(self, keys, func):
+        future = WriteFuture()
+        with self._cond:
+            if self._pid != os.getpid():
+                # The writer thread didn't survive a fork (if there was
+                # one), and the parent's writes are the parent's business.
+                self._pending = []
+                self._busy = False
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._pending.append((keys, func, future))
+            self._cond.notify_all()
+        return future
+
+    def join(self):
+        """Wait until everything queued so far has been applied."""
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            while self._pending or self._busy:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch, self._pending = self._pending, []
+                self._busy = True
+            try:
+                self._apply(batch)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _apply(self, batch):
+        results = []
+        db = _ShelveSession(self._stores)
+        try:
+            db.open('c', lazy=True)
+            db._lock_keys(set(key for keys, func, future in batch
+                              for key in keys))
+            for keys, func, future in batch:
+                try:
+                    results.append((future, func(db), None))
+                except Exception as e:
+                    results.append((future, None, e))
+            db.close()
+        except Exception as e:
+            db.close()
+            results = [(future, None, e) for keys, func, future in batch]
+        for future, result, error in results:
+            future._set(result, error)
+
+
+class _ValueCache(object):
+    """An LRU cache of deserialized values read from a store.
+
+    Values are only valid for the write generation they were read at.
+    The cache is validated whenever a read lock is acquired, and is
+    emptied as soon as a new generation is seen.  Values are shared by
+    every request in the process, so they must not be modified.
+
+    Readers that don't lock the db may still be reading an older
+    generation than the cache's, so every access says which generation
+    the reader is at, and the cache is only used if they match.
+
+    """
+    def __init__(self, size):
+        self._size = size
+        self._mutex = threading.Lock()
+        self._values = collections.OrderedDict()
+        self._generation = None
+
+    def validate(self, generation):
+        with self._mutex:
+            if generation != self._generation:
+                self._values.clear()
+                self._generation = generation
+
+    def has(self, key, generation):
+        with self._mutex:
+            return generation == self._generation and key in self._values
+
+    def get(self, key, generation):
+        """Return the value of ``key``, raise KeyError if it's not cached.
+        """
+        with self._mutex:
+            if generation != self._generation:
+                raise KeyError(key)
+            value = self._values.pop(key)
+            # Move the key to the most recently used end.
+            self._values[key] = value
+            return value
+
+    def put(self, key, value, generation):
+        with self._mutex:
+            if generation != self._generation:
+                return
+            self._values[key] = value
+            while len(self._values) > self._size:
+                self._values.popitem(last=False)
+
+
+class _HandlePool(object):
+    """Shelve handles kept open between requests.
+
+    Opening a shelve means opening the dbm file and reading its index,
+    which is a large part of the cost of a short request.  Instead,
+    handles are checked back in at teardown and reused by later requests
+    in the same process.
+
+    Every handle is tagged with the lock file generation it was last
+    valid at.  A writer bumps the generation when it releases the lock,
+    so a handle is only reused if no one (in any process) has written to
+    the db since; otherwise it is thrown away and a new one is opened.
+
+    """
+    def __init__(self, size, opener):
+        self._size = size
+        self._opener = opener
+        self._mutex = threading.Lock()
+        self._idle = {}
+        self._pid = os.getpid()
+
+    def checkout(self, flag, generation):
+        stale = []
+        handle = None
+        with self._mutex:
+            if self._pid != os.getpid():
+                # We've been forked, the idle handles belong to the parent.
+                for idle in self._idle.values():
+                    stale.extend(idle)
+                self._idle = {}
+                self._pid = os.getpid()
+            idle = self._idle.get(flag, [])
+            while idle:
+                handle = idle.pop()
+                if handle.generation == generation:
+                    break
+                stale.append(handle)
+                handle = None
+        for old in stale:
+            _discard(old)
+        if handle is None:
+            handle = self._opener(flag)
+            handle.flag = flag
+        return handle
+
+    def checkin(self, handle, generation):
+        """Return a handle to the pool.
+
+        Writers must already have been synced.
+
+        """
+        # Values cached for writeback belong to the request that read
+        # them, they must not leak into the next one.
+        handle.drop_cache()
+        handle.modified = False
+        handle.generation = generation
+        # A synced dumbdbm still thinks it's modified, so it would rewrite
+        # its index again whenever it's closed, possibly long after someone
+        # else has written to the db.
+        if getattr(handle.dict, '_modified', False):
+            handle.dict._modified = False
+        with self._mutex:
+            idle = self._idle.setdefault(handle.flag, [])
+            if self._pid == os.getpid() and len(idle) < self._size:
+                idle.append(handle)
+                return
+        handle.close()
+
+
+def _discard(handle):
+    """Close a pooled handle without writing anything back to disk."""
+    db = handle.dict
+    # dumbdbm rewrites its whole index file when it's closed, which would
+    # clobber anything written through other handles since this handle
+    # was opened.  There's nothing left to flush, so drop the index first.
+    if getattr(db, '_index', None) is not None:
+        db._index = None
+    handle.drop_cache()
+    handle.close()
+
+
+def _deadline(timeout):
+    if timeout is None:
+        return None
+    return _timer() + timeout
+
+
+def _flock(fileno, operation, deadline):
+    """flock() ``fileno``, return True once it's locked.
+
+    flock() can't time out, so unless the deadline is None (wait for as
+    long as it takes), a lock that isn't free is waited for in a helper
+    thread blocked in flock(), which gets the lock as soon as it's
+    released.  Returns False if the deadline has already passed and the
+    lock isn't free, ``fileno`` is left as it was.  Returns None if the
+    deadline passed while waiting: the helper thread is still blocked on
+    ``fileno`` and now owns it, it unlocks and closes it once flock()
+    returns, so the caller must not use ``fileno`` again.  Threads of
+    this process have already been through the in-process lock by now,
+    so this only waits on other processes.
+
+    """
+    if deadline is None:
+        fcntl.flock(fileno, operation)
+        return True
+    try:
+        fcntl.flock(fileno, operation | fcntl.LOCK_NB)
+        return True
+    except IOError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+    if deadline <= _timer():
+        return False
+    if _FlockWaiter(fileno, operation).wait(deadline):
+        return True
+    return None
+
+
+class _FlockWaiter(object):
+    """A thread blocked in flock() on behalf of a caller with a deadline.
+
+    If the caller gives up before the lock arrives, the descriptor is
+    abandoned to the thread, which unlocks and closes it as soon as
+    flock() returns.
+
+    """
+    def __init__(self, fileno, operation):
+        self._fileno = fileno
+        self._operation = operation
+        self._done = threading.Event()
+        self._mutex = threading.Lock()
+        self._abandoned = False
+        self._error = None
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        try:
+            fcntl.flock(self._fileno, self._operation)
+        except Exception as e:
+            self._error = e
+        with self._mutex:
+            self._done.set()
+            if not self._abandoned:
+                return
+        if self._error is None:
+            # The descriptor may have been inherited by a forked child,
+            # closing our copy wouldn't release the lock.
+            fcntl.flock(self._fileno, fcntl.LOCK_UN)
+        os.close(self._fileno)
+
+    def wait(self, deadline):
+        """Return True once locked, False if not locked by ``deadline``."""
+        self._done.wait(max(deadline - _timer(), 0))
+        with self._mutex:
+            if not self._done.is_set():
+                self._abandoned = True
+                return False
+        if self._error is not None:
+            raise self._error
+        return True
+
+
+class _ReadWriteLock(object):
+    """A reader/writer lock for the threads of a single process.
+
+    With the 'writer' policy, new readers wait for as long as a writer
+    is waiting, so a steady stream of readers can't starve writers.
+    With the 'fair' policy the lock is granted in the order it was asked
+    for, and consecutive readers share it.
+
+    """
+    POLICIES = ('writer', 'fair')
+
+    def __init__(self, policy='writer'):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown lock policy %r, expected one of: %s" %
+                             (policy, ', '.join(self.POLICIES)))
+        self._fair = policy == 'fair'
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+        # Waiters in arrival order, only used by the fair policy.
+        self._queue = collections.deque()
+
+    def acquire_read(self, blocking=True, timeout=None):
+        """Acquire the lock for reading.
+
+        Returns False if ``blocking`` is false and the lock can't be
+        acquired right away, or if it isn't acquired within ``timeout``
+        seconds.
+
+        """
+        deadline = _deadline(timeout)
+        with self._cond:
+            if not blocking:
+                if self._writer or self._waiting_writers or self._queue:
+                    return False
+            elif self._fair:
+                ticket = object()
+                self._queue.append(ticket)
+                while self._writer or self._queue[0] is not ticket:
+                    if not self._wait(deadline):
+                        self._give_up(ticket)
+                        return False
+                self._queue.popleft()
+                # Whoever is next in line may be a reader that can
+                # share the lock with us.
+                self._cond.notify_all()
+            else:
+                while self._writer or self._waiting_writers:
+                    if not self._wait(deadline):
+                        return False
+            self._readers += 1
+            return True
+
+    def acquire_write(self, blocking=True, timeout=None):
+        """Acquire the lock for writing.
+
+        Returns False if ``blocking`` is false and the lock can't be
+        acquired right away, or if it isn't acquired within ``timeout``
+        seconds.
+
+        """
+        deadline = _deadline(timeout)
+        with self._cond:
+            if not blocking:
+                if self._writer or self._readers or self._queue:
+                    return False
+            elif self._fair:
+                ticket = object()
+                self._queue.append(ticket)
+                while (self._writer or self._readers or
+                       self._queue[0] is not ticket):
+                    if not self._wait(deadline):
+                        self._give_up(ticket)
+                        return False
+                self._queue.popleft()
+            else:
+                self._waiting_writers += 1
+                try:
+                    while self._writer or self._readers:
+                        if not self._wait(deadline):
+                            # Readers may be waiting for us to go.
+                            self._cond.notify_all()
+                            return False
+                finally:
+                    self._waiting_writers -= 1
+            self._writer = True
+            return True
+
+    def _wait(self, deadline):
+        # Wait to be notified, return False if the deadline has passed.
+        if deadline is None:
+            self._cond.wait()
+            return True
+        remaining = deadline - _timer()
+        if remaining <= 0:
+            return False
+        self._cond.wait(remaining)
+        return True
+
+    def _give_up(self, ticket):
+        # Leave the queue, whoever was behind us may be able to go now.
+        self._queue.remove(ticket)
+        self._cond.notify_all()
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+class _FileLock(object):
+    """A reader/writer lock shared by the threads of every process.
+
+    flock() doesn't prefer writers: a writer waiting for LOCK_EX only
+    gets it once there's a moment with no readers, which under a steady
+    stream of readers from other processes may take a long time.  So
+    the lock is entered through a turnstile, a second file next to the
+    lock file.  A writer holds the turnstile exclusively while it waits
+    for the lock, readers pass through it with a shared lock on their
+    way in, so once a writer is waiting, readers of every process queue
+    up behind it.
+
+    """
+    def __init__(self, lockfile, policy='writer'):
+        self._filename = lockfile
+        self._turnstile = lockfile + '.turnstile'
+        self._policy = policy
+        # flock() only arbitrates between open files, it doesn't know
+        # anything about the threads waiting on it.  Threads in this
+        # process first go through an in-process reader/writer lock,
+        # which wakes them as soon as the lock is free and decides who
+        # goes next.
+        self._rwlock = _ReadWriteLock(policy)
+        # Descriptors of the lock file that aren't currently locked.
+        # They're kept open for the life of the process so acquiring
+        # a lock is just a flock() call.  Every one has a descriptor of
+        # the turnstile of its own, so threads don't share turnstile
+        # locks.
+        self._mutex = threading.Lock()
+        self._idle_fds = []
+        self._turnstile_fds = {}
+        self._pid = os.getpid()
+        # Touch the file so we can acquire read locks.  The file is not
+        # truncated, it holds the write generation shared by every process
+        # using the db.
+        open(self._filename, 'a').close()
+        open(self._turnstile, 'a').close()
+
+    def acquire_read_lock(self, blocking=True, timeout=None):
+        return self._acquire(self._rwlock.acquire_read,
+                             self._rwlock.release_read,
+                             fcntl.LOCK_SH, blocking, timeout)
+
+    def acquire_write_lock(self, blocking=True, timeout=None):
+        return self._acquire(self._rwlock.acquire_write,
+                             self._rwlock.release_write,
+                             fcntl.LOCK_EX, blocking, timeout)
+
+    def _acquire(self, acquire, release, operation, blocking, timeout):
+        # Returns the locked fileno, or None if blocking is false and the
+        # lock isn't free, or if it wasn't acquired within timeout seconds.
+        deadline = _deadline(timeout if blocking else 0)
+        self._check_for_fork()
+        if not acquire(blocking, timeout):
+            return None
+        try:
+            fileno = self._checkout_fd()
+        except:
+            release()
+            raise
+        try:
+            locked = self._pass_turnstile(fileno, operation, deadline)
+        except:
+            self._checkin_fd(fileno)
+            release()
+            raise
+        if not locked:
+            release()
+            return None
+        return fileno
+
+    def _pass_turnstile(self, fileno, operation, deadline):
+        # Returns False if the lock wasn't acquired by the deadline, with
+        # ``fileno`` checked in or, if it was left to a thread still
+        # waiting on it, discarded.
+        turnstile = self._turnstile_fds[fileno]
+        locked = _flock(turnstile, operation, deadline)
+        if locked is None:
+            self._discard_fd(fileno, turnstile)
+            return False
+        if locked:
+            try:
+                locked = _flock(fileno, operation, deadline)
+            finally:
+                fcntl.flock(turnstile, fcntl.LOCK_UN)
+            if locked is None:
+                self._discard_fd(fileno, fileno)
+                return False
+        if not locked:
+            self._checkin_fd(fileno)
+        return locked
+
+    def release_read_lock(self, fileno):
+        fcntl.flock(fileno, fcntl.LOCK_UN)
+        self._checkin_fd(fileno)
+        self._rwlock.release_read()
+
+    def release_write_lock(self, fileno):
+        fcntl.flock(fileno, fcntl.LOCK_UN)
+        self._checkin_fd(fileno)
+        self._rwlock.release_write()
+
+    def _check_for_fork(self):
+        if self._pid == os.getpid():
+            return
+        with self._mutex:
+            if self._pid == os.getpid():
+                return
+            # A forked child shares the open file descriptions (and so the
+            # flocks) of its parent's descriptors, it has to open its own.
+            # Closing the inherited copies leaves the parent's locks alone.
+            # Only the forking thread survives a fork, so whatever the
+            # other threads held in the in-process lock is gone too.
+            for fileno in self._idle_fds:
+                os.close(fileno)
+                os.close(self._turnstile_fds.pop(fileno))
+            self._idle_fds = []
+            self._rwlock = _ReadWriteLock(self._policy)
+            self._pid = os.getpid()
+
+    def _checkout_fd(self):
+        with self._mutex:
+            if self._idle_fds:
+                return self._idle_fds.pop()
+        fileno = os.open(self._filename, os.O_RDWR)
+        try:
+            turnstile = os.open(self._turnstile, os.O_RDWR)
+        except:
+            os.close(fileno)
+            raise
+        with self._mutex:
+            self._turnstile_fds[fileno] = turnstile
+        return fileno
+
+    def _checkin_fd(self, fileno):
+        with self._mutex:
+            if self._pid == os.getpid():
+                self._idle_fds.append(fileno)
+                return
+            turnstile = self._turnstile_fds.pop(fileno)
+        os.close(fileno)
+        os.close(turnstile)
+
+    def _discard_fd(self, fileno, abandoned):
+        # Close a lock file descriptor and its turnstile, except for the
+        # one of them given up to the thread still waiting to lock it.
+        with self._mutex:
+            turnstile = self._turnstile_fds.pop(fileno)
+        for fd in (fileno, turnstile):
+            if fd != abandoned:
+                os.close(fd)
+
+    def upgrade_lock(self, fileno, timeout=None):
+        """Turn a read lock on ``fileno`` into a write lock.
+
+        The read lock is released before the write lock is acquired, two
+        readers upgrading at the same time would otherwise deadlock.
+        Returns False, with neither lock held, if the write lock isn't
+        acquired within ``timeout`` seconds.
+
+        """
+        deadline = _deadline(timeout)
+        fcntl.flock(fileno, fcntl.LOCK_UN)
+        self._rwlock.release_read()
+        if not self._rwlock.acquire_write(timeout=timeout):
+            self._checkin_fd(fileno)
+            return False
+        try:
+            locked = self._pass_turnstile(fileno, fcntl.LOCK_EX, deadline)
+        except:
+            self._rwlock.release_write()
+            raise
+        if not locked:
+            self._rwlock.release_write()
+        return locked
+
+    def generation(self, fileno):
+        """Return the write generation stored in the lock file.
+
+        The caller must hold a lock on ``fileno``.
+
+        """
+        os.lseek(fileno, 0, os.SEEK_SET)
+        data = os.read(fileno, _GENERATION.size)
+        if len(data) < _GENERATION.size:
+            return 0
+        return _GENERATION.unpack(data)[0]
+
+    def bump_generation(self, fileno):
+        """Increment the write generation and return the new value.
+
+        The caller must hold the write lock on ``fileno``.
+
+        """
+        generation = self.generation(fileno) + 1
+        os.lseek(fileno, 0, os.SEEK_SET)
+        os.write(fileno, _GENERATION.pack(generation))
+        return generation
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+
+# Measure how many requests/sec a flask-shelve app can serve, and
+# the latency of its requests, under a mix of reads and writes.
+# The app is driven in process through the test client, so the
+# numbers aren't dominated by the cost of an http server, from
+# any number of threads in any number of processes.  Every run
+# uses a fresh db that's been seeded with --keys keys.
+#
+# Usage:
+#
+#   benchmark.py run [options]        Run one configuration.
+#   benchmark.py suite [NAME ...]     Run the configurations of the
+#                                     locking, backends and serializers
+#                                     suites (all of them by default).
+#   benchmark.py compare OLD NEW      Compare two results files.
+#
+# Results are written as JSON, to stdout or to the file given with
+# --output, and a summary of each configuration is printed to
+# stderr as it finishes.  Every result has the configuration's
+# name and parameters, the requests/sec, the p50/p95/p99 latency
+# of reads and writes in ms and the time spent waiting for locks.
+# Every write also increments a counter, "lost_writes" is how far
+# short of the number of writes the counter ended up, which should
+# always be 0.
+#
+# "compare" matches the results of the two files by name and flags
+# a configuration whose throughput dropped, or whose p99 latency
+# rose, by more than --threshold percent.  It exits with status 1
+# if any did, so it can gate a CI job.
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import flask
+import flask_shelve
+
+# Parameters of a run, and their defaults.
+DEFAULTS = {
+    'requests': 500,
+    'threads': 4,
+    'processes': 1,
+    'keys': 1000,
+    # Bytes of a string value, for --value string.
+    'value_size': 100,
+    # 'string' or 'words' (word frequency tables).
+    'value': 'string',
+    'write_ratio': 0.1,
+    'writeback': False,
+    'protocol': None,
+    'pool_size': 4,
+    'backend': 'dbm',
+    'serializer': 'pickle',
+    'lock_policy': 'writer',
+}
+# Name -> parameters of the configurations of each suite.
+SUITES = {
+    'locking': [
+        ('pool=%d,policy=%s' % (pool_size, policy),
+         {'pool_size': pool_size, 'lock_policy': policy})
+        for pool_size in (0, 4) for policy in ('writer', 'fair')],
+    'backends': [
+        ('backend=%s,mix=%s' % (backend, mix),
+         {'backend': backend, 'write_ratio': write_ratio})
+        for backend in ('dbm', 'sqlite', 'log', 'snapshot')
+        for mix, write_ratio in (('read', 0.1), ('write', 0.5))],
+    'serializers': [
+        ('serializer=%s,mix=%s' % (serializer, mix),
+         {'serializer': serializer, 'write_ratio': write_ratio,
+          'value': 'words', 'backend': 'sqlite'})
+        for serializer in ('pickle', 'marshal', 'json')
+        for mix, write_ratio in (('read', 0.1), ('write', 0.5))],
+}
+SUITE_ORDER = ['locking', 'backends', 'serializers']
+# Number of words in the tables of --value words.
+NUM_WORDS = 200
+
+
+def make_value(params, i):
+    if params['value'] == 'words':
+        # A value like the word frequency tables in examples/awesome.py.
+        return dict(('word%d' % j, i + j) for j in range(NUM_WORDS))
+    return ('%d:' % i).ljust(params['value_size'], 'x')
+
+
+def make_app(dirname, params):
+    app = flask.Flask('benchmark')
+    app.config.update({
+        'SHELVE_FILENAME': os.path.join(dirname, 'bench.db'),
+        'SHELVE_WRITEBACK': params['writeback'],
+        'SHELVE_PROTOCOL': params['protocol'],
+        'SHELVE_POOL_SIZE': params['pool_size'],
+        'SHELVE_BACKEND': params['backend'],
+        'SHELVE_SERIALIZER': params['serializer'],
+        'SHELVE_LOCK_POLICY': params['lock_policy'],
+    })
+    flask_shelve.init_app(app)
+    num_keys = params['keys']
+
+    @app.route('/read/<int:i>')
+    def read(i):
+        db = flask_shelve.get_shelve('r')
+        return str(len(str(db.get('key%d' % (i % num_keys)))))
+
+    @app.route('/write/<int:i>', methods=['POST'])
+    def write(i):
+        db = flask_shelve.get_shelve('c')
+        db['key%d' % (i % num_keys)] = make_value(params, i)
+        db.incr('writes')
+        return ''
+
+    return app
+
+
+def seed(app, params):
+    with app.app_context():
+        with flask_shelve.shelve_session('c') as db:
+            db.set_many(dict(('key%d' % i, make_value(params, i))
+                             for i in range(params['keys'])))
+            db['writes'] = 0
+
+
+def make_requests(app, params, offset, latencies):
+    client = app.test_client()
+    # Spread the writes evenly, rather than bunching them up.
+    writes = 0
+    for n in range(params['requests']):
+        i = offset + n
+        write = int((n + 1) * params['write_ratio']) > writes
+        start = time.time()
+        if write:
+            writes += 1
+            rv = client.post('/write/%d' % i)
+        else:
+            rv = client.get('/read/%d' % i)
+        elapsed = time.time() - start
+        if rv.status_code != 200:
+            raise RuntimeError("Request failed: %s" % rv.status)
+        latencies['write' if write else 'read'].append(elapsed)
+
+
+def run_process(dirname, params, index):
+    """Run the threads of one process, return their measurements."""
+    app = make_app(dirname, params)
+    latencies = {'read': [], 'write': []}
+    threads = [
+        threading.Thread(target=make_requests,
+                         args=(app, params,
+                               (index * params['threads'] + i) *
+                               params['requests'], latencies))
+        for i in range(params['threads'])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with app.app_context():
+        stats = flask_shelve.get_stats()
+    return latencies, stats
+
+
+def _run_process(args):
+    return run_process(*args)
+
+
+def percentiles(times):
+    times = sorted(times)
+    if not times:
+        return None
+    return dict(('p%d' % percent,
+                 times[min(len(times) - 1,
+                           int(len(times) * percent / 100.0))] * 1000)
+                for percent in (50, 95, 99))
+
+
+def histogram_percentiles(histogram):
+    # Upper bounds of the buckets the percentiles fall in.
+    total = sum(count for bound, count in histogram)
+    if not total:
+        return None
+    result = {}
+    for percent in (50, 95, 99):
+        seen = 0
+        for bound, count in histogram:
+            seen += count
+            if seen >= total * percent / 100.0:
+                break
+        result['p%d' % percent] = None if bound is None else bound * 1000
+    return result
+
+
+def run(name, **overrides):
+    params = dict(DEFAULTS)
+    params.update(overrides)
+    dirname = tempfile.mkdtemp()
+    try:
+        seed(make_app(dirname, params), params)
+        jobs = [(dirname, params, i) for i in range(params['processes'])]
+        start = time.time()
+        if params['processes'] == 1:
+            results = [run_process(*jobs[0])]
+        else:
+            pool = multiprocessing.Pool(params['processes'])
+            try:
+                results = pool.map(_run_process, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        elapsed = time.time() - start
+        app = make_app(dirname, params)
+        with app.app_context():
+            with flask_shelve.shelve_session('r') as db:
+                counted = db['writes']
+    finally:
+        shutil.rmtree(dirname)
+    latencies = {'read': [], 'write': []}
+    locks = lock_wait = 0
+    histogram = None
+    for process_latencies, stats in results:
+        for kind in latencies:
+            latencies[kind].extend(process_latencies[kind])
+        locks += stats['locks']
+        lock_wait += stats['lock_wait_seconds']
+        process_histogram = stats['histograms']['lock_wait_seconds']
+        if histogram is None:
+            histogram = process_histogram
+        else:
+            histogram = [(bound, count + other) for (bound, count), (_, other)
+                         in zip(histogram, process_histogram)]
+    num_requests = sum(len(times) for times in latencies.values())
+    return {
+        'name': name,
+        'params': params,
+        'requests': num_requests,
+        'seconds': elapsed,
+        'requests_per_sec': num_requests / elapsed,
+        'read_ms': percentiles(latencies['read']),
+        'write_ms': percentiles(latencies['write']),
+        'locks': locks,
+        'lock_wait_ms': dict(histogram_percentiles(histogram) or {},
+                             total=lock_wait * 1000),
+        'lost_writes': len(latencies['write']) - counted,
+    }
+
+
+def summary(result):
+    parts = ['%-32s %10.1f req/s' % (result['name'],
+                                     result['requests_per_sec'])]
+    for kind in ('read', 'write'):
+        if result['%s_ms' % kind]:
+            parts.append('%s p50/p99 %.2f/%.2f ms' % (
+                kind, result['%s_ms' % kind]['p50'],
+                result['%s_ms' % kind]['p99']))
+    parts.append('lock wait %.1f ms' % result['lock_wait_ms']['total'])
+    if result['lost_writes']:
+        parts.append('LOST %d WRITES' % result['lost_writes'])
+    return '  '.join(parts)
+
+
+def write_results(results, output):
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if output is None:
+        sys.stdout.write(data + '\n')
+    else:
+        with open(output, 'w') as f:
+            f.write(data + '\n')
+
+
+def load_results(filename):
+    with open(filename) as f:
+        results = json.load(f)
+    if isinstance(results, dict):
+        results = [results]
+    return dict((result['name'], result) for result in results)
+
+
+def changes(old, new):
+    """Yield (metric, old value, new value, whether higher is worse)."""
+    yield ('requests/sec', old['requests_per_sec'],
+           new['requests_per_sec'], False)
+    for kind in ('read', 'write'):
+        if old['%s_ms' % kind] and new['%s_ms' % kind]:
+            yield ('%s p99 ms' % kind, old['%s_ms' % kind]['p99'],
+                   new['%s_ms' % kind]['p99'], True)
+
+
+def compare(old_filename, new_filename, threshold):
+    """Print how the results changed, return the number of regressions."""
+    old_results = load_results(old_filename)
+    new_results = load_results(new_filename)
+    regressions = 0
+    sys.stdout.write('%-32s %-14s %10s %10s %8s\n' % (
+        'name', 'metric', 'old', 'new', 'change'))
+    for name in sorted(set(old_results) & set(new_results)):
+        old, new = old_results[name], new_results[name]
+        for metric, old_value, new_value, higher_is_worse in changes(old,
+                                                                     new):
+            if not old_value:
+                continue
+            change = (new_value - old_value) * 100.0 / old_value
+            worse = change if higher_is_worse else -change
+            flag = ''
+            if worse > threshold:
+                regressions += 1
+                flag = '  REGRESSION'
+            sys.stdout.write('%-32s %-14s %10.2f %10.2f %+7.1f%%%s\n' % (
+                name, metric, old_value, new_value, change, flag))
+        if new['lost_writes']:
+            regressions += 1
+            sys.stdout.write('%-32s lost %d writes  REGRESSION\n' % (
+                name, new['lost_writes']))
+    for name in sorted(set(old_results) ^ set(new_results)):
+        sys.stdout.write('%-32s only in %s\n' % (
+            name, old_filename if name in old_results else new_filename))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark flask-shelve.")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help="run one configuration")
+    run_parser.add_argument('--name', default='run')
+    for name, default in sorted(DEFAULTS.items()):
+        option = '--' + name.replace('_', '-')
+        if isinstance(default, bool):
+            run_parser.add_argument(option, action='store_true')
+        elif name == 'write_ratio':
+            run_parser.add_argument(option, type=float, default=default)
+        elif isinstance(default, int) or name == 'protocol':
+            run_parser.add_argument(option, type=int, default=default)
+        else:
+            run_parser.add_argument(option, default=default)
+    run_parser.add_argument('-o', '--output')
+
+    suite_parser = commands.add_parser('suite', help="run suites")
+    suite_parser.add_argument('suites', nargs='*', metavar='NAME',
+                              help=', '.join(SUITE_ORDER))
+    suite_parser.add_argument('-o', '--output')
+
+    compare_parser = commands.add_parser('compare',
+                                         help="compare two results files")
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=10.0,
+                                help="percent change that's a regression")
+    args = parser.parse_args(argv)
+    if args.command == 'suite':
+        for name in args.suites:
+            if name not in SUITES:
+                parser.error("Unknown suite: %s" % name)
+        args.suites = args.suites or SUITE_ORDER
+    return args
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if args.command == 'compare':
+        if compare(args.old, args.new, args.threshold):
+            sys.exit(1)
+        return
+    if args.command == 'run':
+        configs = [(args.name, dict((name, getattr(args, name))
+                                    for name in DEFAULTS))]
+    else:
+        configs = [config for suite in args.suites for config in SUITES[suite]]
+    results = []
+    for name, params in configs:
+        result = run(name, **params)
+        sys.stderr.write(summary(result) + '\n')
+        results.append(result)
+    write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
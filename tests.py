@@ -2,12 +2,26 @@
 from __future__ import with_statement
 
 import os
+import sys
+import time
+import pickle
+import fcntl
 import unittest
 import shelve
+import shutil
 import tempfile
+import threading
+from io import BytesIO
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
 
 import flask
-from flask.ext.shelve import init_app, get_shelve
+from flask.ext.shelve import init_app, get_shelve, shelve_session, \
+        get_shelve_async, get_stats, shelve_metrics, ShelveConflictError, \
+        ShelveLockTimeoutError, \
+        _ReadWriteLock, _FileLock, _ShelveSession, _ValueCache
 
 
 class TestFlaskShelve(unittest.TestCase):
@@ -15,10 +29,13 @@ class TestFlaskShelve(unittest.TestCase):
         self.tempfile = tempfile.NamedTemporaryFile()
         # shelve (anydbm) won't work with empty files.
         os.unlink(self.tempfile.name)
+        self.app = self.create_app()
 
-        app = flask.Flask('test-flask-shelve')
+    def create_app(self, name='test-flask-shelve', **config):
+        app = flask.Flask(name)
         app.debug = True
         app.config['SHELVE_FILENAME'] = self.tempfile.name
+        app.config.update(config)
 
         @app.route('/setkey/', methods=['POST'])
         def setkey():
@@ -32,7 +49,7 @@ class TestFlaskShelve(unittest.TestCase):
             return db.get('foo', 'NOEXIST')
 
         init_app(app)
-        self.app = app
+        return app
 
     def get_db(self, mode='r'):
         return shelve.open(self.tempfile.name, mode)
@@ -77,9 +94,1344 @@ class TestFlaskShelve(unittest.TestCase):
         cfg = app.config
         self.assertEqual(cfg['SHELVE_PROTOCOL'], None)
         self.assertEqual(cfg['SHELVE_WRITEBACK'], False)
+        self.assertEqual(cfg['SHELVE_WRITEBACK_MAX_ENTRIES'], 0)
+        self.assertEqual(cfg['SHELVE_WRITEBACK_MAX_BYTES'], 0)
+        self.assertEqual(cfg['SHELVE_POOL_SIZE'], 0)
+        self.assertEqual(cfg['SHELVE_LOCK_POLICY'], 'writer')
+        self.assertEqual(cfg['SHELVE_LOCK_TIMEOUT'], None)
+        self.assertEqual(cfg['SHELVE_READ_LOCK_TIMEOUT'], None)
+        self.assertEqual(cfg['SHELVE_WRITE_LOCK_TIMEOUT'], None)
+        self.assertEqual(cfg['SHELVE_LOCK_RETRY_AFTER'], 1)
+        self.assertEqual(cfg['SHELVE_SHARDS'], 1)
+        self.assertEqual(cfg['SHELVE_CACHE_SIZE'], 0)
+        self.assertEqual(cfg['SHELVE_WRITE_BEHIND'], False)
+        self.assertEqual(cfg['SHELVE_BACKEND'], 'dbm')
+        self.assertEqual(cfg['SHELVE_SERIALIZER'], 'pickle')
+        self.assertEqual(cfg['SHELVE_COMPRESS'], None)
+        self.assertEqual(cfg['SHELVE_COMPRESS_MIN_BYTES'], 1024)
+        self.assertEqual(cfg['SHELVE_SERVER_TIMING'], False)
+        self.assertEqual(cfg['SHELVE_REPLICA'], False)
+        self.assertEqual(cfg['SHELVE_REPLICA_INTERVAL'], 60)
+        self.assertEqual(cfg['SHELVE_REPLICA_WRITES'], 0)
+        self.assertEqual(cfg['SHELVE_REPLICA_MAX_STALENESS'], None)
         self.assertEqual(cfg['SHELVE_LOCKFILE'],
                          self.tempfile.name + '.lock')
 
+    def test_pooled_handles_are_reused_across_requests(self):
+        app = self.create_app(SHELVE_POOL_SIZE=2)
+        handles = []
+
+        @app.route('/handle/')
+        def handle():
+            handles.append(get_shelve('r')._handle(0))
+            return ''
+
+        with app.test_client() as c:
+            c.get('/handle/')
+            c.get('/handle/')
+        self.assertIs(handles[0], handles[1])
+
+    def test_pooled_reader_sees_writes_from_other_processes(self):
+        # A second app on the same files stands in for another process.
+        app = self.create_app(SHELVE_POOL_SIZE=2)
+        other = self.create_app('other-process', SHELVE_POOL_SIZE=2)
+        with app.test_client() as c:
+            self.assertEqual(c.get('/getkey/').data, 'NOEXIST')
+        with other.test_client() as c:
+            c.post('/setkey/')
+        with app.test_client() as c:
+            self.assertEqual(c.get('/getkey/').data, 'bar')
+
+    def assertUnlocked(self, app):
+        for store in app.extensions['shelve'].stores:
+            rwlock = store._lock._rwlock
+            self.assertEqual(rwlock._readers, 0)
+            self.assertFalse(rwlock._writer)
+
+    def test_repeated_calls_return_the_same_db(self):
+        @self.app.route('/twice/')
+        def twice():
+            first = get_shelve('r')
+            self.assertIs(get_shelve('r'), first)
+            self.assertIs(get_shelve('c'), first)
+            self.assertIs(get_shelve('r'), first)
+            return ''
+
+        with self.app.test_client() as c:
+            c.get('/twice/')
+        self.assertUnlocked(self.app)
+
+    def test_read_db_is_upgraded_to_a_writer(self):
+        @self.app.route('/upgrade/')
+        def upgrade():
+            db = get_shelve('r')
+            value = db.get('foo', 'NOEXIST')
+            get_shelve('c')
+            db['foo'] = value + ' upgraded'
+            return db['foo']
+
+        with self.app.test_client() as c:
+            rv = c.get('/upgrade/')
+        self.assertEqual(rv.data, 'NOEXIST upgraded')
+        self.assertEqual(self.get_db()['foo'], 'NOEXIST upgraded')
+        self.assertUnlocked(self.app)
+
+    def test_upgrade_with_pooled_handles(self):
+        app = self.create_app(SHELVE_POOL_SIZE=2)
+
+        @app.route('/upgrade/')
+        def upgrade():
+            db = get_shelve('r')
+            get_shelve('c')
+            db['foo'] = 'upgraded'
+            return ''
+
+        with app.test_client() as c:
+            c.get('/upgrade/')
+            self.assertEqual(c.get('/getkey/').data, 'upgraded')
+        self.assertUnlocked(app)
+
+    def is_locked(self, app):
+        rwlock = app.extensions['shelve'].stores[0]._lock._rwlock
+        return bool(rwlock._readers or rwlock._writer)
+
+    def test_lazy_db_is_locked_on_first_use(self):
+        self.get_db('c')['foo'] = 'lazy'
+
+        @self.app.route('/lazy/')
+        def lazy():
+            db = get_shelve('r', lazy=True)
+            self.assertFalse(self.is_locked(self.app))
+            value = db['foo']
+            self.assertTrue(self.is_locked(self.app))
+            return value
+
+        with self.app.test_client() as c:
+            self.assertEqual(c.get('/lazy/').data, 'lazy')
+        self.assertUnlocked(self.app)
+
+    def test_shelve_session_releases_lock_on_exit(self):
+        @self.app.route('/session/')
+        def session():
+            with shelve_session('c') as db:
+                db['foo'] = 'session'
+                self.assertTrue(self.is_locked(self.app))
+            self.assertFalse(self.is_locked(self.app))
+            # The db can still be opened again afterwards.
+            return get_shelve('r')['foo']
+
+        with self.app.test_client() as c:
+            self.assertEqual(c.get('/session/').data, 'session')
+        self.assertEqual(self.get_db()['foo'], 'session')
+        self.assertUnlocked(self.app)
+
+    def test_shelve_session_outside_of_a_request(self):
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db['foo'] = 'no request'
+            with shelve_session('r') as db:
+                self.assertEqual(db['foo'], 'no request')
+        self.assertUnlocked(self.app)
+
+    def test_cached_values_are_reused_until_the_next_write(self):
+        self.get_db('c')['foo'] = {'count': 1}
+        app = self.create_app(SHELVE_CACHE_SIZE=10)
+        other = self.create_app('other-process')
+        values = []
+
+        @app.route('/cached/')
+        def cached():
+            values.append(get_shelve('r')['foo'])
+            return ''
+
+        with app.test_client() as c:
+            c.get('/cached/')
+            c.get('/cached/')
+        self.assertIs(values[0], values[1])
+        with other.test_client() as c:
+            c.post('/setkey/')
+        with app.test_client() as c:
+            c.get('/cached/')
+        self.assertEqual(values[2], 'bar')
+
+    def test_incr_only_locks_for_the_operation(self):
+        @self.app.route('/incr/')
+        def incr():
+            db = get_shelve('r')
+            count = db.incr('counter')
+            self.assertFalse(self.is_locked(self.app))
+            self.assertEqual(db['counter'], count)
+            return str(count)
+
+        with self.app.test_client() as c:
+            self.assertEqual(c.get('/incr/').data, '1')
+            self.assertEqual(c.get('/incr/').data, '2')
+        self.assertUnlocked(self.app)
+
+    def test_concurrent_incr(self):
+        def incr():
+            with self.app.app_context():
+                with shelve_session('r') as db:
+                    for i in range(20):
+                        db.incr('counter')
+
+        threads = [threading.Thread(target=incr) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.get_db()['counter'], 100)
+
+    def test_atomic_operations(self):
+        with self.app.app_context():
+            with shelve_session('r') as db:
+                self.assertEqual(db.setdefault('foo', 'first'), 'first')
+                self.assertEqual(db.setdefault('foo', 'second'), 'first')
+                db.update({'a': 1}, b=2)
+                self.assertTrue(db.cas('a', 1, 10))
+                self.assertFalse(db.cas('b', 1, 10))
+                self.assertFalse(db.cas('missing', None, 10))
+                self.assertEqual(db.incr('b', 5), 7)
+        db = self.get_db()
+        self.assertEqual(db['foo'], 'first')
+        self.assertEqual(db['a'], 10)
+        self.assertEqual(db['b'], 7)
+        self.assertNotIn('missing', db)
+
+    def test_atomic_operations_in_a_write_session(self):
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db['counter'] = 5
+                self.assertEqual(db.incr('counter', -2), 3)
+                self.assertTrue(db.writable)
+        self.assertEqual(self.get_db()['counter'], 3)
+
+    def test_get_many_and_set_many(self):
+        @self.app.route('/many/')
+        def many():
+            db = get_shelve('r')
+            db.set_many({'a': 1, 'b': [2]})
+            self.assertFalse(self.is_locked(self.app))
+            self.assertEqual(db.get_many(['a', 'b', 'c']),
+                             {'a': 1, 'b': [2]})
+            return ''
+
+        with self.app.test_client() as c:
+            c.get('/many/')
+        db = self.get_db()
+        self.assertEqual(db['a'], 1)
+        self.assertEqual(db['b'], [2])
+
+    def test_get_many_uses_the_writeback_cache(self):
+        app = self.create_app(SHELVE_WRITEBACK=True)
+        with app.app_context():
+            with shelve_session('c') as db:
+                db['a'] = [1]
+                db['a'].append(2)
+                self.assertEqual(db.get_many(['a']), {'a': [1, 2]})
+                db.set_many({'b': [3]})
+                db['b'].append(4)
+        self.assertEqual(self.get_db()['a'], [1, 2])
+        self.assertEqual(self.get_db()['b'], [3, 4])
+
+    def test_writeback_only_writes_changed_values(self):
+        app = self.create_app(SHELVE_WRITEBACK=True)
+        store = app.extensions['shelve'].stores[0]
+        with app.app_context():
+            with shelve_session('c') as db:
+                db['a'] = [1]
+                db['b'] = [2]
+            fileno, handle = store.acquire('r')
+            generation = store._lock.generation(fileno)
+            store.release(fileno, handle, False)
+            # Reading values with writeback doesn't write them back.
+            with shelve_session('c') as db:
+                self.assertEqual(db.get_many(['a', 'b']),
+                                 {'a': [1], 'b': [2]})
+            fileno, handle = store.acquire('r')
+            self.assertEqual(store._lock.generation(fileno), generation)
+            store.release(fileno, handle, False)
+            with shelve_session('c') as db:
+                db['a'].append(3)
+                db['b']
+            fileno, handle = store.acquire('r')
+            self.assertEqual(store._lock.generation(fileno), generation + 1)
+            store.release(fileno, handle, False)
+        self.assertEqual(self.get_db()['a'], [1, 3])
+
+    def test_writeback_cache_is_bounded(self):
+        for config in ({'SHELVE_WRITEBACK_MAX_ENTRIES': 3},
+                       {'SHELVE_WRITEBACK_MAX_BYTES': 200}):
+            app = self.create_app(SHELVE_WRITEBACK=True, **config)
+            with app.app_context():
+                with shelve_session('c') as db:
+                    db.set_many(dict(('key%d' % i, ['x' * 50])
+                                     for i in range(10)))
+                with shelve_session('c') as db:
+                    db['key0'].append(0)
+                    for i in range(10):
+                        db['key%d' % i].append(i)
+                        handle = db._held[0][1]
+                        self.assertTrue(len(handle.cache) <= 3)
+                    # Evicted values are written back.
+                    self.assertEqual(db['key0'], ['x' * 50, 0, 0])
+            db = self.get_db()
+            self.assertEqual(db['key0'], ['x' * 50, 0, 0])
+            for i in range(1, 10):
+                self.assertEqual(db['key%d' % i], ['x' * 50, i])
+
+    def test_readers_do_not_write_back(self):
+        app = self.create_app(SHELVE_WRITEBACK=True,
+                              SHELVE_WRITEBACK_MAX_ENTRIES=1)
+        with app.app_context():
+            with shelve_session('c') as db:
+                db.set_many({'a': [1], 'b': [2]})
+            with shelve_session('r') as db:
+                db['a'].append(3)
+                # Evicts 'a' from the cache.
+                db['b']
+                db.sync()
+        self.assertEqual(self.get_db()['a'], [1])
+
+    def test_pickles_use_the_highest_protocol(self):
+        with self.app.test_client() as c:
+            c.post('/setkey/')
+        db = self.get_db()
+        self.assertEqual(db.dict['foo'][:2],
+                         '\x80' + chr(pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(db['foo'], 'bar')
+
+    def test_serializers(self):
+        for serializer in ('marshal', 'json'):
+            app = self.create_app(SHELVE_SERIALIZER=serializer)
+            with app.app_context():
+                with shelve_session('c') as db:
+                    db[serializer] = {'words': [1, 2.5, None]}
+        # Records are readable whichever serializer wrote them.
+        with self.app.app_context():
+            with shelve_session('r') as db:
+                self.assertEqual(db['marshal'], {'words': [1, 2.5, None]})
+                self.assertEqual(db.get_many(['json']),
+                                 {'json': {'words': [1, 2.5, None]}})
+        db = self.get_db()
+        self.assertEqual(db.dict['json'][:2], '\x00j')
+
+    def test_unknown_serializer(self):
+        self.assertRaises(ValueError, self.create_app,
+                          SHELVE_SERIALIZER='nope')
+
+    def test_large_values_are_compressed(self):
+        app = self.create_app(SHELVE_COMPRESS='zlib')
+        words = dict(('word%d' % i, i) for i in range(1000))
+        with app.app_context():
+            with shelve_session('c') as db:
+                db['words'] = words
+                db['small'] = 'bar'
+            with shelve_session('r') as db:
+                self.assertEqual(db['words'], words)
+                self.assertEqual(db.get_many(['words']), {'words': words})
+            stats = get_stats()
+        self.assertEqual(stats['compressed_records'], 1)
+        self.assertEqual(stats['decompressed_records'], 2)
+        self.assertTrue(stats['compress_bytes_saved'] > 0)
+        db = self.get_db()
+        self.assertEqual(db.dict['words'][:2], '\x00z')
+        self.assertEqual(db['small'], 'bar')
+        db.close()
+        # Compressed records are still readable without compression.
+        with self.app.app_context():
+            with shelve_session('r') as db:
+                self.assertEqual(db['words'], words)
+
+    def test_lock_timeout_sheds_the_request(self):
+        app = self.create_app(SHELVE_LOCK_TIMEOUT=0.1,
+                              SHELVE_LOCK_RETRY_AFTER=5)
+        store = app.extensions['shelve'].stores[0]
+        fileno, handle = store.acquire('c')
+        try:
+            start = time.time()
+            rv = app.test_client().get('/getkey/')
+            self.assertTrue(time.time() - start < 2)
+        finally:
+            store.release(fileno, handle, True, dirty=False)
+        self.assertEqual(rv.status_code, 503)
+        self.assertEqual(rv.headers['Retry-After'], '5')
+        with app.app_context():
+            self.assertEqual(get_stats()['lock_timeouts'], 1)
+        # The timed out reader didn't keep anything locked.
+        rv = app.test_client().post('/setkey/')
+        self.assertEqual(rv.status_code, 200)
+
+    def test_upgrade_times_out(self):
+        app = self.create_app(SHELVE_WRITE_LOCK_TIMEOUT=0.1)
+        with app.test_request_context():
+            db = get_shelve('r')
+            other = _ShelveSession(app.extensions['shelve'].stores)
+            other.open('r')
+            self.assertRaises(ShelveLockTimeoutError, get_shelve, 'c')
+            other.close()
+            db = get_shelve('c')
+            db['foo'] = 'bar'
+
+    def test_stats_count_locks_and_records(self):
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db['foo'] = 'bar'
+                del db['foo']
+                db['baz'] = 'qux'
+            with shelve_session('r') as db:
+                self.assertEqual(db['baz'], 'qux')
+            stats = get_stats()
+        self.assertEqual(stats['locks'], 2)
+        self.assertEqual(stats['keys_written'], 2)
+        self.assertEqual(stats['keys_deleted'], 1)
+        self.assertEqual(stats['keys_read'], 1)
+        self.assertEqual(stats['bytes_read'],
+                         len(pickle.dumps('qux', pickle.HIGHEST_PROTOCOL)))
+        for name in ('lock_wait_seconds', 'lock_hold_seconds'):
+            histogram = stats['histograms'][name]
+            self.assertEqual(sum(count for bound, count in histogram), 2)
+            self.assertEqual(histogram[-1][0], None)
+
+    @unittest.skipIf(not flask.signals_available, "blinker isn't installed")
+    def test_metrics_are_sent_at_teardown(self):
+        sent = []
+
+        def receiver(app, metrics):
+            sent.append(metrics)
+        shelve_metrics.connect(receiver, self.app)
+        try:
+            with self.app.test_client() as c:
+                c.post('/setkey/')
+        finally:
+            shelve_metrics.disconnect(receiver, self.app)
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0]['locks'], 1)
+        self.assertEqual(sent[0]['keys_written'], 1)
+        self.assertEqual(sent[0]['keys_read'], 1)
+
+    def test_server_timing_header(self):
+        app = self.create_app(SHELVE_SERVER_TIMING=True)
+        rv = app.test_client().post('/setkey/')
+        timings = rv.headers['Server-Timing'].split(', ')
+        self.assertEqual([timing.split(';')[0] for timing in timings],
+                         ['shelve-lock-wait', 'shelve-lock-hold',
+                          'shelve-open', 'shelve-close'])
+        rv = self.app.test_client().post('/setkey/')
+        self.assertNotIn('Server-Timing', rv.headers)
+
+    def test_blobs_are_stored_in_chunks(self):
+        data = b''.join(b'%02d' % i for i in range(50))
+        with self.app.app_context():
+            with shelve_session('r') as db:
+                self.assertEqual(db.put_stream('blob', BytesIO(data), 16),
+                                 100)
+                blob = db.open_stream('blob')
+                self.assertEqual(blob.size, 100)
+                self.assertEqual(blob.read(20), data[:20])
+                self.assertEqual(b''.join(blob), data[20:])
+                self.assertEqual(db.open_stream('blob').read(), data)
+                # Replacing a blob drops the chunks it no longer needs.
+                db.put_stream('blob', [b'abc', b'defgh', b'ij'], 4)
+                self.assertEqual(list(db.open_stream('blob')),
+                                 [b'abcd', b'efgh', b'ij'])
+                self.assertEqual(len(db._all_keys()), 4)
+                db.delete_stream('blob')
+                self.assertEqual(db._all_keys(), [])
+                self.assertRaises(KeyError, db.open_stream, 'blob')
+
+    def test_failed_put_stream_keeps_the_old_blob(self):
+        def source():
+            yield b'B' * 5
+            raise IOError()
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db.put_stream('blob', [b'A' * 10], 4)
+                self.assertRaises(IOError, db.put_stream, 'blob', source(),
+                                  4)
+                self.assertEqual(db.open_stream('blob').read(), b'A' * 10)
+            with shelve_session('r') as db:
+                self.assertEqual(db.open_stream('blob').read(), b'A' * 10)
+                self.assertEqual(len(db._all_keys()), 4)
+
+    def test_blobs_can_be_streamed_to_the_client(self):
+        data = b'x' * 100000
+
+        @self.app.route('/blob/')
+        def blob():
+            db = get_shelve('r')
+            return flask.Response(flask.stream_with_context(
+                db.open_stream('blob')))
+
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db.put_stream('blob', BytesIO(data))
+        self.assertEqual(self.app.test_client().get('/blob/').data, data)
+        self.assertUnlocked(self.app)
+
+    def test_hash_fields_are_stored_separately(self):
+        with self.app.app_context():
+            with shelve_session('r') as db:
+                words = db.hash('awesome_words')
+                words.incr_many({'python': 2, 'flask': 1})
+                self.assertEqual(words.incr('python'), 3)
+                self.assertEqual(words.get_many(['python', 'nope']),
+                                 {'python': 3})
+        db = self.get_db()
+        self.assertEqual(len(db), 2)
+        self.assertNotIn('awesome_words', db)
+
+    def test_hashes_and_blobs_are_not_keys(self):
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db['foo'] = 'bar'
+                db.hash('words').incr_many({'python': 1, 'flask': 1})
+                db.put_stream('blob', [b'data'])
+                self.assertEqual(db.keys(), ['foo'])
+                self.assertEqual(len(db), 1)
+                self.assertEqual(dict(db), {'foo': 'bar'})
+                self.assertEqual(len(db.hash('words')), 2)
+
+    def test_hash_mapping_interface(self):
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db['awesome_words'] = 'not part of the hash'
+                words = db.hash('awesome_words')
+                words['a'] = 1
+                words['b'] = 2
+                db.hash('lame_words')['c'] = 3
+                self.assertEqual(sorted(words.items()), [('a', 1), ('b', 2)])
+                self.assertEqual(len(words), 2)
+                del words['a']
+                self.assertNotIn('a', words)
+                self.assertEqual(words.get('a', 'missing'), 'missing')
+                self.assertEqual(db['awesome_words'], 'not part of the hash')
+
+
+class TestWriteBehind(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'db')
+        self.app = flask.Flask('test-flask-shelve-write-behind')
+        self.app.config['SHELVE_FILENAME'] = self.filename
+        self.app.config['SHELVE_WRITE_BEHIND'] = True
+        init_app(self.app)
+
+    def tearDown(self):
+        self.app.extensions['shelve'].queue.join()
+        shutil.rmtree(self.tempdir)
+
+    def test_queued_writes_are_applied(self):
+        @self.app.route('/write/', methods=['POST'])
+        def write():
+            db = get_shelve('c')
+            db['foo'] = 'bar'
+            count = db.incr('counter', 2)
+            db.flush()
+            return str(count.result())
+
+        with self.app.test_client() as c:
+            self.assertEqual(c.post('/write/').data, '2')
+            self.assertEqual(c.post('/write/').data, '4')
+        db = shelve.open(self.filename, 'r')
+        self.assertEqual(db['foo'], 'bar')
+        self.assertEqual(db['counter'], 4)
+
+    def test_truncating_is_refused(self):
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db['foo'] = 'bar'
+                db.flush()
+            with self.app.test_request_context():
+                self.assertRaises(ValueError, get_shelve, 'n')
+            with shelve_session('r') as db:
+                self.assertEqual(db['foo'], 'bar')
+
+    def test_failed_writes_raise_from_their_future(self):
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db['foo'] = 'not a number'
+                future = db.incr('foo')
+                self.assertRaises(TypeError, future.result, 1)
+
+    def test_concurrent_writes_are_batched(self):
+        store = self.app.extensions['shelve'].stores[0]
+        # Hold the write lock so writes pile up in the queue.
+        fileno, handle = store.acquire('c')
+        futures = []
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                for i in range(10):
+                    futures.append(db.incr('counter'))
+        generation = store._lock.generation(fileno)
+        store.release(fileno, handle, True, dirty=False)
+        self.assertEqual(sorted(f.result(1) for f in futures),
+                         list(range(1, 11)))
+        fileno, handle = store.acquire('r')
+        # The first write may have been taken on its own before the rest
+        # queued up behind it, but the others are applied in one batch.
+        self.assertTrue(store._lock.generation(fileno) - generation <= 2)
+        store.release(fileno, handle, False)
+
+
+@unittest.skipIf(asyncio is None, "asyncio isn't available")
+class TestAsync(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.app = flask.Flask('test-flask-shelve-async')
+        self.app.config['SHELVE_FILENAME'] = os.path.join(self.tempdir, 'db')
+        init_app(self.app)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        shutil.rmtree(self.tempdir)
+
+    def run_async(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def test_get_and_set(self):
+        with self.app.test_request_context():
+            db = self.run_async(get_shelve_async('c'))
+            self.run_async(db.set('foo', 'bar'))
+            self.run_async(db.set_many({'a': 1, 'b': 2}))
+            self.assertEqual(self.run_async(db.incr('a')), 2)
+            self.assertEqual(self.run_async(db.get('foo')), 'bar')
+            self.assertEqual(self.run_async(db.get_many(['a', 'b'])),
+                             {'a': 2, 'b': 2})
+            # It's the request's session.
+            self.assertIs(db.session, get_shelve('c'))
+
+    def test_waiting_for_a_lock_does_not_block_the_loop(self):
+        store = self.app.extensions['shelve'].stores[0]
+        fileno, handle = store.acquire('c')
+        ticks = []
+
+        def tick():
+            ticks.append(None)
+            if len(ticks) == 5:
+                store.release(fileno, handle, True)
+            else:
+                self.loop.call_later(0.01, tick)
+
+        def read(db):
+            return db.get('foo', 'NOEXIST')
+
+        with self.app.app_context():
+            self.loop.call_soon(tick)
+            opened = get_shelve_async('r').__aenter__()
+            db = self.run_async(opened)
+            self.assertEqual(len(ticks), 5)
+            self.assertEqual(self.run_async(db.call(read)), 'NOEXIST')
+            self.run_async(db.close())
+            # The session was closed, a writer can lock the db.
+            acquired = store.acquire('c', blocking=False)
+            self.assertIsNotNone(acquired)
+            store.release(acquired[0], acquired[1], True, dirty=False)
+
+
+class TestSqliteBackend(unittest.TestCase):
+    backend = 'sqlite'
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.app = self.create_app()
+
+    def create_app(self, **config):
+        app = flask.Flask('test-flask-shelve-%s' % self.backend)
+        app.config['SHELVE_FILENAME'] = os.path.join(self.tempdir, 'db')
+        app.config['SHELVE_BACKEND'] = self.backend
+        app.config.update(config)
+        init_app(app)
+        return app
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_mapping_interface(self):
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db['foo'] = {'bar': 1}
+                db['baz'] = 2
+                del db['baz']
+                self.assertRaises(KeyError, db.__delitem__, 'baz')
+                db.hash('words').incr('python')
+            with shelve_session('r') as db:
+                self.assertEqual(db['foo'], {'bar': 1})
+                self.assertNotIn('baz', db)
+                self.assertEqual(len(db), 1)
+                self.assertEqual(dict(db.hash('words')), {'python': 1})
+
+    def test_readers_do_not_block_the_writer(self):
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db['foo'] = 'old'
+            reader = _ShelveSession(self.app.extensions['shelve'].stores)
+            reader.open('r')
+            self.assertEqual(reader['foo'], 'old')
+
+            def write():
+                with self.app.app_context():
+                    with shelve_session('c') as db:
+                        db['foo'] = 'new'
+            writer = threading.Thread(target=write)
+            writer.start()
+            writer.join(5)
+            self.assertFalse(writer.is_alive())
+            # The reader keeps reading from its snapshot.
+            self.assertEqual(reader['foo'], 'old')
+            reader.close()
+            with shelve_session('r') as db:
+                self.assertEqual(db['foo'], 'new')
+
+    def test_pooled_and_cached_reads_see_new_writes(self):
+        app = self.create_app(SHELVE_POOL_SIZE=2, SHELVE_CACHE_SIZE=10)
+        with app.app_context():
+            for value in ('one', 'two'):
+                with shelve_session('c') as db:
+                    db['foo'] = value
+                for i in range(2):
+                    with shelve_session('r') as db:
+                        self.assertEqual(db['foo'], value)
+
+    def test_writers_that_change_nothing_keep_the_generation(self):
+        store = self.app.extensions['shelve'].stores[0]
+
+        def generation():
+            fileno, handle = store.acquire('r')
+            store.release(fileno, handle, False)
+            return handle.generation
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db['foo'] = 'bar'
+            before = generation()
+            for i in range(3):
+                with shelve_session('c') as db:
+                    self.assertEqual(db['foo'], 'bar')
+            self.assertEqual(generation(), before)
+            with shelve_session('c') as db:
+                db['foo'] = 'baz'
+            self.assertNotEqual(generation(), before)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, self.create_app,
+                          SHELVE_BACKEND='nope')
+
+
+class TestLogBackend(TestSqliteBackend):
+    backend = 'log'
+
+    def log_size(self):
+        store = self.app.extensions['shelve'].stores[0]
+        fileno, handle = store.acquire('r')
+        try:
+            return os.path.getsize(handle.dict._log_filename(
+                handle.dict._log_number))
+        finally:
+            store.release(fileno, handle, False)
+
+    def test_index_grows(self):
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db.set_many(dict(('key%d' % i, i) for i in range(100)))
+            for i in range(100, 200):
+                with shelve_session('c') as db:
+                    db['key%d' % i] = i
+            with shelve_session('r') as db:
+                self.assertEqual(db.get_many(['key0', 'key150']),
+                                 {'key0': 0, 'key150': 150})
+                self.assertEqual(len(db), 200)
+
+    def test_compaction_reclaims_space(self):
+        store = self.app.extensions['shelve'].stores[0]
+        with self.app.app_context():
+            for i in range(20):
+                with shelve_session('c') as db:
+                    db['blob'] = 'x' * 10000 + str(i)
+                    db['gone'] = i
+            # A reader that started before the delete and the compaction
+            # keeps reading the old log.
+            reader = _ShelveSession(self.app.extensions['shelve'].stores)
+            reader.open('r')
+            self.assertEqual(reader['gone'], 19)
+            with shelve_session('c') as db:
+                del db['gone']
+            before = self.log_size()
+            fileno, handle = store.acquire('c')
+            handle.dict.compact()
+            store.release(fileno, handle, True, dirty=False)
+            self.assertTrue(self.log_size() < before / 10)
+            self.assertEqual(reader['gone'], 19)
+            reader.close()
+            with shelve_session('r') as db:
+                self.assertEqual(db['blob'], 'x' * 10000 + '19')
+                self.assertNotIn('gone', db)
+
+    def test_compaction_writes_records_a_buffer_at_a_time(self):
+        store = self.app.extensions['shelve'].stores[0]
+        values = dict(('key%d' % i, str(i) * 5000) for i in range(40))
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db.set_many(values)
+            fileno, handle = store.acquire('c')
+            handle.dict.compact()
+            store.release(fileno, handle, True, dirty=False)
+            with shelve_session('r') as db:
+                self.assertEqual(db.get_many(list(values)), values)
+
+    def test_writeback_appends_only_changed_values(self):
+        app = self.create_app(SHELVE_WRITEBACK=True)
+        with app.app_context():
+            with shelve_session('c') as db:
+                db.set_many(dict(('key%d' % i, [i]) for i in range(10)))
+            before = self.log_size()
+            with shelve_session('c') as db:
+                for i in range(10):
+                    db['key%d' % i]
+                db['key0'].append('x')
+            # One record (prev, lengths, key and value) was appended.
+            self.assertTrue(self.log_size() - before < 100)
+            with shelve_session('r') as db:
+                self.assertEqual(db['key0'], [0, 'x'])
+
+    def test_writer_killed_while_updating_the_index(self):
+        module = sys.modules[_ShelveSession.__module__]
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db['foo'] = 'old'
+            pid = os.fork()
+            if not pid:
+                # Die after updating the first slot, with the index's
+                # sequence counter left odd.
+                slot = module._LOG_SLOT
+
+                class DyingSlot(object):
+                    size = slot.size
+                    unpack_from = slot.unpack_from
+                    updated = 0
+
+                    def pack_into(self, *args):
+                        if self.updated:
+                            os._exit(0)
+                        self.updated += 1
+                        slot.pack_into(*args)
+                module._LOG_SLOT = DyingSlot()
+                try:
+                    with shelve_session('c') as db:
+                        db.set_many({'foo': 'new', 'bar': 'new'})
+                finally:
+                    os._exit(1)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            stall = module._LOG_STALL_SECONDS
+            module._LOG_STALL_SECONDS = 0.05
+            try:
+                # Readers don't wait for the dead writer for long.
+                with shelve_session('r') as db:
+                    self.assertEqual(db.get_many(['foo', 'bar']),
+                                     {'foo': 'old'})
+            finally:
+                module._LOG_STALL_SECONDS = stall
+            # The next writer repairs the index.
+            with shelve_session('c') as db:
+                db['baz'] = 'new'
+            with shelve_session('r') as db:
+                self.assertEqual(db.get_many(['foo', 'bar', 'baz']),
+                                 {'foo': 'old', 'baz': 'new'})
+                self.assertEqual(len(db), 2)
+
+    def test_unpublished_appends_are_discarded(self):
+        store = self.app.extensions['shelve'].stores[0]
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db['foo'] = 'bar'
+            # What a writer that died half way through a sync leaves.
+            fileno, handle = store.acquire('r')
+            log = handle.dict._log_filename(handle.dict._log_number)
+            store.release(fileno, handle, False)
+            with open(log, 'ab') as f:
+                f.write(b'garbage')
+            with shelve_session('c') as db:
+                db['baz'] = 'qux'
+            with shelve_session('r') as db:
+                self.assertEqual(db.get_many(['foo', 'baz']),
+                                 {'foo': 'bar', 'baz': 'qux'})
+
+
+class TestSnapshotBackend(TestSqliteBackend):
+    backend = 'snapshot'
+
+    def versions(self):
+        return sorted(name for name in os.listdir(self.tempdir)
+                      if name.startswith('db.v') and name.endswith('.lock'))
+
+    def test_old_versions_are_deleted_once_unread(self):
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db['foo'] = 'one'
+            reader = _ShelveSession(self.app.extensions['shelve'].stores)
+            reader.open('r')
+            self.assertEqual(reader['foo'], 'one')
+            for value in ('two', 'three'):
+                with shelve_session('c') as db:
+                    db['foo'] = value
+            # The version the reader has open is kept.
+            self.assertEqual(self.versions(), ['db.v1.lock', 'db.v3.lock'])
+            self.assertEqual(reader['foo'], 'one')
+            reader.close()
+            with shelve_session('c') as db:
+                db['foo'] = 'four'
+            self.assertEqual(self.versions(), ['db.v4.lock'])
+            with shelve_session('r') as db:
+                self.assertEqual(db['foo'], 'four')
+
+    def test_new_versions_are_dated_when_published(self):
+        pointer = os.path.join(self.tempdir, 'db')
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db['foo'] = 'bar'
+            os.utime(pointer, (0, 0))
+            with shelve_session('c') as db:
+                db['foo'] = 'baz'
+            self.assertTrue(os.path.getmtime(pointer) > time.time() - 60)
+
+    def test_unpublished_versions_are_replaced(self):
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db['foo'] = 'bar'
+            # What a writer that died before publishing leaves.
+            with open(os.path.join(self.tempdir, 'db.v2.lock'), 'w'):
+                pass
+            with shelve_session('c') as db:
+                db['baz'] = 'qux'
+            with shelve_session('r') as db:
+                self.assertEqual(db.get_many(['foo', 'baz']),
+                                 {'foo': 'bar', 'baz': 'qux'})
+            self.assertEqual(self.versions(), ['db.v2.lock'])
+
+
+class TestReplica(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.app = self.create_app()
+
+    def create_app(self, **config):
+        app = flask.Flask('test-flask-shelve-replica')
+        app.config['SHELVE_FILENAME'] = os.path.join(self.tempdir, 'db')
+        app.config['SHELVE_REPLICA'] = True
+        app.config['SHELVE_REPLICA_INTERVAL'] = None
+        app.config['SHELVE_READ_LOCK_TIMEOUT'] = 0.1
+        app.config.update(config)
+        init_app(app)
+        return app
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def replica(self, app=None):
+        return (app or self.app).extensions['shelve'].stores[0].replica
+
+    def test_reads_from_the_replica_do_not_lock(self):
+        store = self.app.extensions['shelve'].stores[0]
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db['foo'] = 'old'
+            self.assertTrue(self.replica().refresh())
+            fileno, handle = store.acquire('c')
+            try:
+                handle['foo'] = 'new'
+                with shelve_session('r') as db:
+                    self.assertEqual(db['foo'], 'old')
+                # Too stale, so the db itself is read.
+                with shelve_session('r', max_staleness=0) as db:
+                    self.assertRaises(ShelveLockTimeoutError, db.get, 'foo')
+            finally:
+                store.release(fileno, handle, True)
+            with shelve_session('r', max_staleness=0) as db:
+                self.assertEqual(db['foo'], 'new')
+
+    def test_db_is_read_until_there_is_a_replica(self):
+        with self.app.app_context():
+            with shelve_session('c') as db:
+                db['foo'] = 'bar'
+            with shelve_session('r') as db:
+                self.assertEqual(db['foo'], 'bar')
+            # The read started a refresh.
+            self.replica()._thread.join(5)
+            store = self.app.extensions['shelve'].stores[0]
+            fileno, handle = store.acquire('c')
+            try:
+                with shelve_session('r') as db:
+                    self.assertEqual(db['foo'], 'bar')
+            finally:
+                store.release(fileno, handle, True, dirty=False)
+
+    def test_replica_is_refreshed_every_n_writes(self):
+        app = self.create_app(SHELVE_REPLICA_WRITES=2)
+        with app.app_context():
+            for value in ('one', 'two'):
+                with shelve_session('c') as db:
+                    db['foo'] = value
+            self.replica(app)._thread.join(5)
+            with shelve_session('c') as db:
+                db['foo'] = 'three'
+            with shelve_session('r') as db:
+                self.assertEqual(db['foo'], 'two')
+
+    def test_replica_values_are_cached_apart(self):
+        app = self.create_app(SHELVE_CACHE_SIZE=10)
+        with app.app_context():
+            with shelve_session('c') as db:
+                db['foo'] = 'A'
+                db['bar'] = 'x'
+            self.replica(app).refresh()
+            self.replica(app).refresh()
+            with shelve_session('c') as db:
+                db['foo'] = 'B'
+            # The replica's version and the db's generation are both 2.
+            with shelve_session('r', max_staleness=0) as db:
+                self.assertEqual(db['bar'], 'x')
+            with shelve_session('r') as db:
+                self.assertEqual(db['foo'], 'A')
+            with shelve_session('r', max_staleness=0) as db:
+                self.assertEqual(db['foo'], 'B')
+
+    def test_upgraded_sessions_read_the_db(self):
+        with self.app.test_request_context():
+            with shelve_session('c') as db:
+                db['foo'] = 'old'
+            self.replica().refresh()
+            with shelve_session('c') as db:
+                db['foo'] = 'new'
+            db = get_shelve('r')
+            self.assertEqual(db['foo'], 'old')
+            db = get_shelve('c')
+            self.assertEqual(db['foo'], 'new')
+
+
+class TestValueCache(unittest.TestCase):
+    def test_least_recently_used_values_are_evicted(self):
+        cache = _ValueCache(2)
+        cache.validate(1)
+        cache.put('a', 1, 1)
+        cache.put('b', 2, 1)
+        cache.get('a', 1)
+        cache.put('c', 3, 1)
+        self.assertTrue(cache.has('a', 1))
+        self.assertFalse(cache.has('b', 1))
+        self.assertTrue(cache.has('c', 1))
+
+    def test_new_generation_empties_the_cache(self):
+        cache = _ValueCache(2)
+        cache.validate(1)
+        cache.put('a', 1, 1)
+        cache.validate(1)
+        self.assertTrue(cache.has('a', 1))
+        cache.validate(2)
+        self.assertFalse(cache.has('a', 2))
+
+    def test_other_generations_are_not_cached(self):
+        cache = _ValueCache(2)
+        cache.validate(2)
+        cache.put('a', 1, 1)
+        self.assertFalse(cache.has('a', 2))
+        cache.put('a', 2, 2)
+        self.assertRaises(KeyError, cache.get, 'a', 1)
+        self.assertEqual(cache.get('a', 2), 2)
+
+
+class TestShards(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'db')
+        self.app = flask.Flask('test-flask-shelve-shards')
+        self.app.config['SHELVE_FILENAME'] = self.filename
+        self.app.config['SHELVE_SHARDS'] = 4
+        init_app(self.app)
+        self.stores = self.app.extensions['shelve'].stores
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def session(self, mode):
+        session = _ShelveSession(self.stores)
+        session.open(mode)
+        return session
+
+    def keys_in_shards(self, *shards):
+        # Return a key that hashes to each of the given shards.
+        session = _ShelveSession(self.stores)
+        keys = []
+        for shard in shards:
+            i = 0
+            while session._index('key%d' % i) != shard:
+                i += 1
+            keys.append('key%d' % i)
+        return keys
+
+    def test_keys_are_spread_across_shards(self):
+        db = self.session('c')
+        for i in range(20):
+            db['key%d' % i] = i
+        db.close()
+        counts = [len(shelve.open('%s.%d' % (self.filename, i), 'r'))
+                  for i in range(4)]
+        self.assertEqual(sum(counts), 20)
+        self.assertEqual(len([c for c in counts if c]), 4)
+        db = self.session('r')
+        self.assertEqual(sorted(db.keys()),
+                         sorted('key%d' % i for i in range(20)))
+        self.assertEqual(len(db), 20)
+        self.assertEqual(db['key7'], 7)
+        db.close()
+
+    def test_writers_on_different_shards_run_in_parallel(self):
+        first, second = self.keys_in_shards(0, 1)
+        db = self.session('c')
+        db[first] = 'first'
+        done = []
+
+        def write_other_shard():
+            other = self.session('c')
+            other[second] = 'second'
+            other.close()
+            done.append(True)
+
+        t = threading.Thread(target=write_other_shard)
+        t.daemon = True
+        t.start()
+        t.join(1)
+        self.assertEqual(done, [True])
+        db.close()
+
+    def test_shards_are_relocked_in_order_when_clean(self):
+        low, high = self.keys_in_shards(0, 3)
+        db = self.session('c')
+        db.get(high)
+        db[low] = 'low'
+        db[high] = 'high'
+        self.assertEqual(sorted(db._held), [0, 3])
+        db.close()
+
+    def test_conflict_when_lower_shard_is_busy_after_a_write(self):
+        low, high = self.keys_in_shards(0, 3)
+        other = self.session('c')
+        other[low] = 'other'
+        db = self.session('c')
+        db[high] = 'high'
+        self.assertRaises(ShelveConflictError, db.get, low)
+        db.close()
+        other.close()
+
+    def test_get_many_locks_every_shard_up_front(self):
+        keys = self.keys_in_shards(3, 0, 2)
+        db = self.session('c')
+        db.set_many(dict((key, key) for key in keys))
+        db.close()
+        db = self.session('r')
+        self.assertEqual(db.get_many(keys), dict((key, key) for key in keys))
+        self.assertEqual(sorted(db._held), [0, 2, 3])
+        db.close()
+
+    def test_update_across_shards(self):
+        keys = self.keys_in_shards(3, 0, 2)
+        db = self.session('r')
+        db.update(dict((key, key) for key in keys))
+        self.assertEqual(db._held, {})
+        self.assertEqual(sorted(db.keys()), sorted(keys))
+        db.close()
+
+    def test_blob_chunks_are_kept_in_one_shard(self):
+        db = self.session('c')
+        db.put_stream('blob', BytesIO(b'x' * 100), 10)
+        self.assertEqual(list(db._held), [db._index('\x00blob\x00blob\x00')])
+        self.assertEqual(len(db._all_keys()), 11)
+        db.close()
+
+
+class TestReadWriteLock(unittest.TestCase):
+    def start(self, target, *args):
+        t = threading.Thread(target=target, args=args)
+        t.daemon = True
+        t.start()
+        # Give the thread a chance to block on the lock.
+        time.sleep(0.05)
+        return t
+
+    def reader(self, lock, name, order):
+        lock.acquire_read()
+        order.append(name)
+        lock.release_read()
+
+    def writer(self, lock, name, order):
+        lock.acquire_write()
+        order.append(name)
+        lock.release_write()
+
+    def test_acquire_times_out(self):
+        for policy in _ReadWriteLock.POLICIES:
+            lock = _ReadWriteLock(policy)
+            lock.acquire_write()
+            self.assertFalse(lock.acquire_read(timeout=0.05))
+            self.assertFalse(lock.acquire_write(timeout=0.05))
+            lock.release_write()
+            # Nothing was left behind by the waiters that gave up.
+            self.assertTrue(lock.acquire_write(blocking=False))
+            lock.release_write()
+            self.assertTrue(lock.acquire_read(blocking=False))
+            lock.release_read()
+
+    def test_waiting_writer_blocks_new_readers(self):
+        lock = _ReadWriteLock('writer')
+        order = []
+        lock.acquire_read()
+        w = self.start(self.writer, lock, 'w', order)
+        r = self.start(self.reader, lock, 'r', order)
+        self.assertEqual(order, [])
+        lock.release_read()
+        w.join(1)
+        r.join(1)
+        self.assertEqual(order, ['w', 'r'])
+
+    def test_writer_policy_lets_writers_go_first(self):
+        lock = _ReadWriteLock('writer')
+        order = []
+        lock.acquire_write()
+        r = self.start(self.reader, lock, 'r', order)
+        w = self.start(self.writer, lock, 'w', order)
+        lock.release_write()
+        r.join(1)
+        w.join(1)
+        self.assertEqual(order, ['w', 'r'])
+
+    def test_fair_policy_grants_in_arrival_order(self):
+        lock = _ReadWriteLock('fair')
+        order = []
+        lock.acquire_write()
+        r = self.start(self.reader, lock, 'r', order)
+        w = self.start(self.writer, lock, 'w', order)
+        lock.release_write()
+        r.join(1)
+        w.join(1)
+        self.assertEqual(order, ['r', 'w'])
+
+    def test_readers_share_the_lock(self):
+        lock = _ReadWriteLock('fair')
+        order = []
+        lock.acquire_read()
+        r = self.start(self.reader, lock, 'r', order)
+        r.join(1)
+        self.assertEqual(order, ['r'])
+        lock.release_read()
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, _ReadWriteLock, 'bogus')
+
+
+class TestFileLock(unittest.TestCase):
+    def setUp(self):
+        self.tempfile = tempfile.NamedTemporaryFile()
+        self.lock = _FileLock(self.tempfile.name)
+
+    def tearDown(self):
+        self.tempfile.close()
+        os.unlink(self.tempfile.name + '.turnstile')
+
+    def test_lock_fds_are_reused(self):
+        fileno = self.lock.acquire_read_lock()
+        self.lock.release_read_lock(fileno)
+        self.assertEqual(self.lock.acquire_write_lock(), fileno)
+
+    def test_waiting_writer_blocks_readers_of_other_processes(self):
+        # Locks of the same file with their own in-process locks are as
+        # good as locks in other processes.
+        reader = _FileLock(self.tempfile.name)
+        other = _FileLock(self.tempfile.name)
+        fileno = reader.acquire_read_lock()
+        acquired = []
+        writer = threading.Thread(
+            target=lambda: acquired.append(self.lock.acquire_write_lock()))
+        writer.daemon = True
+        writer.start()
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            other_fileno = other.acquire_read_lock(blocking=False)
+            if other_fileno is None:
+                break
+            other.release_read_lock(other_fileno)
+            time.sleep(0.01)
+        else:
+            self.fail("Readers weren't kept out by the waiting writer.")
+        self.assertEqual(acquired, [])
+        reader.release_read_lock(fileno)
+        writer.join(5)
+        self.assertEqual(len(acquired), 1)
+        self.lock.release_write_lock(acquired[0])
+        other.release_read_lock(other.acquire_read_lock())
+
+    def test_file_lock_times_out(self):
+        other = _FileLock(self.tempfile.name)
+        fileno = other.acquire_write_lock()
+        start = time.time()
+        self.assertEqual(self.lock.acquire_read_lock(timeout=0.1), None)
+        self.assertEqual(self.lock.acquire_write_lock(timeout=0.1), None)
+        self.assertTrue(time.time() - start < 2)
+        other.release_write_lock(fileno)
+        self.lock.release_write_lock(self.lock.acquire_write_lock(timeout=1))
+
+    def test_late_lock_of_timed_out_wait_is_released(self):
+        blocker = os.open(self.tempfile.name, os.O_RDWR)
+        fcntl.flock(blocker, fcntl.LOCK_EX)
+        self.assertEqual(self.lock.acquire_write_lock(timeout=0.1), None)
+        fcntl.flock(blocker, fcntl.LOCK_UN)
+        # The thread left waiting gets the lock now, and has to let it go.
+        deadline = time.time() + 5
+        while True:
+            try:
+                fcntl.flock(blocker, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError:
+                self.assertTrue(time.time() < deadline)
+                time.sleep(0.01)
+        fcntl.flock(blocker, fcntl.LOCK_UN)
+        os.close(blocker)
+        self.lock.release_write_lock(self.lock.acquire_write_lock(timeout=1))
+
+    def test_timed_lock_is_acquired_when_released(self):
+        blocker = os.open(self.tempfile.name, os.O_RDWR)
+        fcntl.flock(blocker, fcntl.LOCK_EX)
+        timer = threading.Timer(0.2, fcntl.flock, (blocker, fcntl.LOCK_UN))
+        timer.start()
+        try:
+            fileno = self.lock.acquire_read_lock(timeout=5)
+            self.assertNotEqual(fileno, None)
+            self.lock.release_read_lock(fileno)
+        finally:
+            timer.join()
+            os.close(blocker)
+
+    def test_forked_child_opens_its_own_lock_fds(self):
+        self.lock.release_read_lock(self.lock.acquire_read_lock())
+        locked_r, locked_w = os.pipe()
+        done_r, done_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            self.lock.acquire_write_lock()
+            os.write(locked_w, b'x')
+            os.read(done_r, 1)
+            os._exit(0)
+        try:
+            os.read(locked_r, 1)
+            # If the child had reused our descriptor, it would be sharing
+            # its lock with us.
+            fileno = self.lock._checkout_fd()
+            self.assertRaises(IOError, fcntl.flock, fileno,
+                              fcntl.LOCK_SH | fcntl.LOCK_NB)
+        finally:
+            os.write(done_w, b'x')
+            os.waitpid(pid, 0)
+
 
 if __name__ == '__main__':
     unittest.main()